@@ -0,0 +1,626 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Pushshift search and Reddit API endpoints used by
+the scripts, serving a synthetic subreddit.
+
+Pushshift : /meta, /reddit/search/{submission,comment} and
+/reddit/{submission,comment}/search (psaw).
+Reddit : /api/v1/access_token, /api/v1/me, /api/info, /api/morechildren,
+/comments/<id>, /user/<name>/{about,comments,submitted} and
+/r/<subreddit>/{new,comments}.
+"""
+
+import argparse
+import bisect
+import functools
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger()
+
+POST_BASE = 36**5
+COMMENT_BASE = 36**6
+# comments are created at most COMMENT_SPAN seconds after their post
+COMMENT_SPAN = 2 * 24 * 3600
+# one post out of REMOVED_EVERY is missing from /api/info
+REMOVED_EVERY = 50
+# seconds of the buckets of the created_utc aggregations, by frequency
+AGG_FREQUENCIES = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+WORDS = [
+    "france",
+    "paris",
+    "politique",
+    "forum",
+    "libre",
+    "vélo",
+    "fromage",
+    "grève",
+    "météo",
+    "rugby",
+    "cinéma",
+    "internet",
+]
+FLAIRS = [None, "Forum Libre", "Politique", "Culture", "Science", "Sport"]
+DOMAINS = ["self.{}", "lemonde.fr", "youtube.com", "i.redd.it", "lefigaro.fr"]
+
+
+def base36(number):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while number:
+        number, digit = divmod(number, 36)
+        result = digits[digit] + result
+    return result or "0"
+
+
+class SyntheticReddit:
+    """
+    Deterministic subreddit of posts and comment trees
+    """
+
+    def __init__(
+        self,
+        subreddit="bench",
+        posts=2000,
+        comments=20,
+        users=50,
+        start=1500000000,
+        end=1600000000,
+        seed=0,
+    ):
+        self.subreddit = subreddit
+        self.users = users
+        self.seed = seed
+        rng = random.Random(seed)
+        self.times = sorted(rng.randint(start, end) for _ in range(posts))
+        self.comment_counts = [rng.randint(0, 2 * comments) for _ in range(posts)]
+        self.comment_offsets = [0]
+        for count in self.comment_counts:
+            self.comment_offsets.append(self.comment_offsets[-1] + count)
+        self.post_authors = [f"user_{rng.randrange(users)}" for _ in range(posts)]
+        self.post_index = {self.post_id(i): i for i in range(posts)}
+        self._user_comments = None
+        self._lock = threading.Lock()
+
+    def post_id(self, index):
+        return base36(POST_BASE + index)
+
+    def comment_id(self, post, k):
+        return base36(COMMENT_BASE + self.comment_offsets[post] + k)
+
+    def locate_comment(self, comment_id):
+        """
+        Return the (post, k) of a comment ID
+        """
+        number = int(comment_id, 36) - COMMENT_BASE
+        post = bisect.bisect_right(self.comment_offsets, number) - 1
+        return post, number - self.comment_offsets[post]
+
+    def post(self, i):
+        rng = random.Random(self.seed * 7919 + i)
+        post_id = self.post_id(i)
+        words = rng.sample(WORDS, 3)
+        domain = rng.choice(DOMAINS).format(self.subreddit)
+        permalink = f"/r/{self.subreddit}/comments/{post_id}/{'_'.join(words)}/"
+        return {
+            "id": post_id,
+            "name": f"t3_{post_id}",
+            "title": " ".join(words).capitalize(),
+            "selftext": " ".join(rng.choices(WORDS, k=rng.randint(0, 60))),
+            "author": self.post_authors[i],
+            "author_flair_css_class": None,
+            "author_flair_text": rng.choice(FLAIRS),
+            "link_flair_text": rng.choice(FLAIRS),
+            "created_utc": self.times[i],
+            "score": rng.randint(0, 5000),
+            "upvote_ratio": round(rng.random(), 2),
+            "num_comments": self.comment_counts[i],
+            "gilded": 0,
+            "hidden": False,
+            "archived": False,
+            "can_gild": True,
+            "is_crosspostable": True,
+            "domain": domain,
+            "url": f"https://{domain}/{post_id}",
+            "permalink": permalink,
+            "full_link": f"https://www.reddit.com{permalink}",
+            "subreddit": self.subreddit,
+            "subreddit_id": "t5_bench",
+            "subreddit_subscribers": 100000,
+            "thumbnail": "self",
+        }
+
+    @functools.lru_cache(maxsize=4096)
+    def comments(self, i):
+        """
+        Comments of post i, parents always before their children
+        """
+        rng = random.Random(self.seed * 104729 + i)
+        post_id = self.post_id(i)
+        offsets = sorted(
+            rng.randrange(COMMENT_SPAN) for _ in range(self.comment_counts[i])
+        )
+        result = []
+        for k, offset in enumerate(offsets):
+            parent = -1 if k == 0 or rng.random() < 0.4 else rng.randrange(k)
+            comment_id = self.comment_id(i, k)
+            body = " ".join(rng.choices(WORDS, k=rng.randint(1, 40)))
+            result.append(
+                {
+                    "id": comment_id,
+                    "name": f"t1_{comment_id}",
+                    "parent": parent,
+                    "parent_id": (
+                        f"t3_{post_id}"
+                        if parent < 0
+                        else f"t1_{self.comment_id(i, parent)}"
+                    ),
+                    "link_id": f"t3_{post_id}",
+                    "author": f"user_{rng.randrange(self.users)}",
+                    "body": body,
+                    "score": rng.randint(-20, 500),
+                    "created_utc": self.times[i] + offset,
+                    "gilded": 0,
+                    "edited": False,
+                    "author_flair_text": rng.choice(FLAIRS),
+                    "permalink": f"/r/{self.subreddit}/comments/{post_id}/_/{comment_id}/",
+                    "subreddit": self.subreddit,
+                    "subreddit_id": "t5_bench",
+                }
+            )
+        depth = []
+        for comment in result:
+            depth.append(0 if comment["parent"] < 0 else depth[comment["parent"]] + 1)
+            comment["depth"] = depth[-1]
+        return result
+
+    def user_comments(self, username):
+        """
+        (post, k) of the comments of a user, newest first
+        """
+        with self._lock:
+            if self._user_comments is None:
+                index = {}
+                for i in range(len(self.times)):
+                    for k, comment in enumerate(self.comments(i)):
+                        index.setdefault(comment["author"], []).append(
+                            (comment["created_utc"], i, k)
+                        )
+                self._user_comments = {
+                    user: [(i, k) for _, i, k in sorted(items, reverse=True)]
+                    for user, items in index.items()
+                }
+        return self._user_comments.get(username, [])
+
+    def user_comment(self, i, k):
+        post = self.post(i)
+        comment = dict(self.comments(i)[k])
+        comment.update(
+            link_title=post["title"],
+            link_url=post["url"],
+            link_author=post["author"],
+            link_permalink=post["full_link"],
+        )
+        return comment
+
+
+def thing(kind, data):
+    return {"kind": kind, "data": data}
+
+
+def listing(children, after=None):
+    return {
+        "kind": "Listing",
+        "data": {"children": children, "after": after, "before": None, "dist": None},
+    }
+
+
+def reddit_comment(comment, replies=""):
+    data = {k: v for k, v in comment.items() if k != "parent"}
+    data["replies"] = replies
+    return thing("t1", data)
+
+
+def more(parent_id, children, depth):
+    return thing(
+        "more",
+        {
+            "count": len(children),
+            "children": children,
+            "id": children[0] if children else "_",
+            "name": f"t1_{children[0] if children else '_'}",
+            "parent_id": parent_id,
+            "depth": depth,
+        },
+    )
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        self.handle_request({})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = dict(parse_qsl(self.rfile.read(length).decode("utf-8")))
+        self.handle_request(form)
+
+    def handle_request(self, form):
+        parts = urlsplit(self.path)
+        path = parts.path.rstrip("/") or "/"
+        params = {}
+        # repeated parameters are lists, as Pushshift reads them
+        for key, value in parse_qsl(parts.query):
+            params[key] = f"{params[key]},{value}" if key in params else value
+        params.update(form)
+        server = self.server
+        if path == "/_stats":
+            return self.send_json(server.stats())
+        if server.latency:
+            time.sleep(server.latency)
+        route, payload = server.route(path, params)
+        server.count(route)
+        if payload is None:
+            return self.send_json({"message": "Not Found", "error": 404}, status=404)
+        self.send_json(payload)
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "") and len(body) > 1024
+        if gzipped:
+            body = gzip.compress(body, compresslevel=1)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-ratelimit-remaining", "1000")
+        self.send_header("x-ratelimit-used", "0")
+        self.send_header("x-ratelimit-reset", "600")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, reddit, latency=0, page_limit=1000):
+        super().__init__(address, MockHandler)
+        self.reddit = reddit
+        self.latency = latency
+        self.page_limit = page_limit
+        self._counter = Counter()
+        self._counter_lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, route):
+        with self._counter_lock:
+            self._counter[route] += 1
+
+    def stats(self):
+        with self._counter_lock:
+            return {
+                "requests": sum(self._counter.values()),
+                "routes": dict(self._counter),
+            }
+
+    def route(self, path, params):
+        segments = path.strip("/").split("/")
+        if path == "/meta":
+            return "meta", {"server_ratelimit_per_minute": 6000}
+        if path in ("/reddit/search/submission", "/reddit/submission/search"):
+            return "pushshift_submission", self.pushshift_search("submission", params)
+        if path in ("/reddit/search/comment", "/reddit/comment/search"):
+            return "pushshift_comment", self.pushshift_search("comment", params)
+        if path == "/api/v1/access_token":
+            return "access_token", {
+                "access_token": "mock",
+                "expires_in": 3600,
+                "scope": "*",
+                "token_type": "bearer",
+            }
+        if path == "/api/v1/me":
+            return "me", {"name": "bench", "id": "bench", "created_utc": 1500000000}
+        if path == "/api/info":
+            return "info", self.info(params.get("id", ""))
+        if path == "/api/morechildren":
+            return "morechildren", self.morechildren(params)
+        if segments[0] == "comments" and len(segments) >= 2:
+            return "comments", self.submission_comments(segments[1], params)
+        if segments[0] == "user" and len(segments) == 3:
+            return f"user_{segments[2]}", self.user(segments[1], segments[2], params)
+        if segments[0] == "r" and len(segments) == 3:
+            return f"subreddit_{segments[2]}", self.subreddit_listing(
+                segments[2], params
+            )
+        return "unknown", None
+
+    def pushshift_search(self, kind, params):
+        reddit = self.reddit
+        after = int(float(params.get("after", 0)))
+        before = int(float(params.get("before", 2**40)))
+        size = min(int(params.get("size", params.get("limit", 25))), self.page_limit)
+        descending = params.get("sort", "asc") == "desc"
+        subreddits = params.get("subreddit")
+        subreddits = set(subreddits.lower().split(",")) if subreddits else None
+        authors = params.get("author")
+        authors = set(authors.split(",")) if authors else None
+        query = params.get("q", "").lower().strip('"')
+        fields = params.get("filter", params.get("fields"))
+        fields = set(fields.split(",")) if fields else None
+
+        if subreddits is not None and reddit.subreddit not in subreddits:
+            items = []
+        elif kind == "submission":
+            lo = bisect.bisect_right(reddit.times, after)
+            hi = bisect.bisect_left(reddit.times, before)
+            indexes = range(hi - 1, lo - 1, -1) if descending else range(lo, hi)
+            items = (
+                reddit.post(i)
+                for i in indexes
+                if authors is None or reddit.post_authors[i] in authors
+            )
+            if query:
+                items = (
+                    x
+                    for x in items
+                    if query in (x["title"] + " " + x["selftext"]).lower()
+                )
+        else:
+            if authors is not None:
+                located = [
+                    pair for author in authors for pair in reddit.user_comments(author)
+                ]
+                items = (reddit.user_comment(i, k) for i, k in located)
+            else:
+                lo = bisect.bisect_right(reddit.times, after - COMMENT_SPAN)
+                hi = bisect.bisect_left(reddit.times, before)
+                items = (
+                    reddit.user_comment(i, k)
+                    for i in range(lo, hi)
+                    for k in range(reddit.comment_counts[i])
+                )
+            items = (x for x in items if after < x["created_utc"] < before)
+            if query:
+                items = (x for x in items if query in x["body"].lower())
+            items = sorted(items, key=lambda x: x["created_utc"], reverse=descending)
+
+        aggregated = params.get("aggs") == "created_utc"
+        width = AGG_FREQUENCIES.get(params.get("frequency"), 86400)
+        buckets = Counter()
+        data = []
+        total = 0
+        for item in items:
+            total += 1
+            if aggregated:
+                buckets[item["created_utc"] // width * width] += 1
+            if len(data) < size:
+                item = {k: v for k, v in item.items() if k != "parent"}
+                item.setdefault("updated_utc", item["created_utc"])
+                if fields is not None:
+                    item = {k: v for k, v in item.items() if k in fields}
+                data.append(item)
+            elif params.get("metadata") != "true" and not aggregated:
+                break
+        payload = {"data": data}
+        if aggregated:
+            payload["aggs"] = {
+                "created_utc": [
+                    {"key": key, "doc_count": count}
+                    for key, count in sorted(buckets.items())
+                ]
+            }
+        if params.get("metadata") == "true":
+            payload["metadata"] = {
+                "total_results": total,
+                "size": len(data),
+                "shards": {"successful": 1, "total": 1},
+            }
+        return payload
+
+    def info(self, fullnames):
+        reddit = self.reddit
+        children = []
+        for fullname in fullnames.split(","):
+            index = reddit.post_index.get(fullname.split("_", 1)[-1])
+            if index is None or index % REMOVED_EVERY == REMOVED_EVERY - 1:
+                continue
+            children.append(thing("t3", reddit.post(index)))
+        return listing(children)
+
+    def submission_comments(self, post_id, params):
+        reddit = self.reddit
+        index = reddit.post_index.get(post_id)
+        if index is None:
+            return None
+        comments = reddit.comments(index)
+        limit = int(params.get("limit", 200))
+        children = {}
+        for k, comment in enumerate(comments):
+            children.setdefault(comment["parent"], []).append(k)
+
+        def render(parent, depth):
+            kids = children.get(parent, [])
+            loaded = [reddit_comment(comments[k], "") for k in kids if k < limit]
+            for entry, k in zip(loaded, [k for k in kids if k < limit]):
+                replies = render(k, depth + 1)
+                entry["data"]["replies"] = listing(replies) if replies else ""
+            unloaded = [comments[k]["id"] for k in kids if k >= limit]
+            if unloaded:
+                parent_id = f"t3_{post_id}" if parent < 0 else comments[parent]["name"]
+                loaded.append(more(parent_id, unloaded, depth))
+            return loaded
+
+        return [listing([thing("t3", reddit.post(index))]), listing(render(-1, 0))]
+
+    def morechildren(self, params):
+        reddit = self.reddit
+        requested = [x for x in params.get("children", "").split(",") if x]
+        things = []
+        for comment_id in requested:
+            i, k = reddit.locate_comment(comment_id)
+            comments = reddit.comments(i)
+            comment = comments[k]
+            things.append(reddit_comment(comment))
+            kids = [c["id"] for c in comments[k + 1 :] if c["parent"] == k]
+            if kids:
+                things.append(more(comment["name"], kids, comment["depth"] + 1))
+        return {"json": {"errors": [], "data": {"things": things}}}
+
+    def user(self, username, what, params):
+        reddit = self.reddit
+        if what == "about":
+            return thing(
+                "t2",
+                {"name": username, "id": username, "created_utc": reddit.times[0]},
+            )
+        if what == "comments":
+            items = [
+                ("t1", reddit.user_comment(i, k))
+                for i, k in reddit.user_comments(username)
+            ]
+        elif what == "submitted":
+            items = [
+                ("t3", reddit.post(i))
+                for i in range(len(reddit.times) - 1, -1, -1)
+                if reddit.post_authors[i] == username
+            ]
+        else:
+            return None
+        return self.page(items, params)
+
+    def subreddit_listing(self, what, params):
+        reddit = self.reddit
+        newest = range(len(reddit.times) - 1, max(len(reddit.times) - 1001, -1), -1)
+        if what == "new":
+            items = [("t3", reddit.post(i)) for i in newest]
+        elif what == "comments":
+            items = sorted(
+                (
+                    ("t1", reddit.user_comment(i, k))
+                    for i in newest[:50]
+                    for k in range(reddit.comment_counts[i])
+                ),
+                key=lambda x: x[1]["created_utc"],
+                reverse=True,
+            )
+        else:
+            return None
+        return self.page(items, params)
+
+    def page(self, items, params):
+        """
+        Reddit listing page of at most 100 items, starting after the
+        fullname given by the after parameter
+        """
+        limit = min(int(params.get("limit", 25)), 100)
+        start = 0
+        if params.get("after"):
+            names = [data["name"] for _, data in items]
+            if params["after"] in names:
+                start = names.index(params["after"]) + 1
+        selected = items[start : start + limit]
+        children = [
+            thing(kind, {k: v for k, v in data.items() if k != "parent"})
+            for kind, data in selected
+        ]
+        after = selected[-1][1]["name"] if start + limit < len(items) else None
+        return listing(children, after=after)
+
+
+def start_server(reddit, host="127.0.0.1", port=0, latency=0, page_limit=1000):
+    """
+    Start a MockServer in a background thread and return it
+    """
+    server = MockServer((host, port), reddit, latency=latency, page_limit=page_limit)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main(args):
+    reddit = SyntheticReddit(
+        subreddit=args.subreddit,
+        posts=args.posts,
+        comments=args.comments,
+        users=args.users,
+    )
+    server = MockServer(
+        (args.host, args.port),
+        reddit,
+        latency=args.latency / 1000,
+        page_limit=args.page_limit,
+    )
+    print(f"Serving r/{args.subreddit} on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve a synthetic subreddit through mock Pushshift and Reddit APIs"
+    )
+    parser.add_argument(
+        "--debug",
+        help="Display debugging information",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.INFO,
+    )
+    parser.add_argument(
+        "--host", type=str, help="Default : 127.0.0.1", default="127.0.0.1"
+    )
+    parser.add_argument("--port", type=int, help="Default : 8000", default=8000)
+    parser.add_argument(
+        "-s", "--subreddit", type=str, help="Default : bench", default="bench"
+    )
+    parser.add_argument(
+        "--posts", type=int, help="Number of posts. Default : 2000", default=2000
+    )
+    parser.add_argument(
+        "--comments",
+        type=int,
+        help="Average number of comments per post. Default : 20",
+        default=20,
+    )
+    parser.add_argument(
+        "--users", type=int, help="Number of users. Default : 50", default=50
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        help="Milliseconds added to each response. Default : 0",
+        default=0,
+    )
+    parser.add_argument(
+        "--page_limit",
+        type=int,
+        help="Maximum number of results of a Pushshift request. Default : 1000",
+        default=1000,
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.loglevel)
+    return args
+
+
+if __name__ == "__main__":
+    main(parse_args())
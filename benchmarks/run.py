@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""
+Run the scripts against the mock server and report their throughput
+(records/s, requests/s) and peak memory.
+
+Each script runs in its own temporary folder holding a praw.ini whose
+endpoints point to the mock server, with PUSHSHIFT_URL set to it too.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+from pathlib import Path
+from urllib.request import urlopen
+
+from mock_server import POST_BASE, SyntheticReddit, base36, start_server
+
+logger = logging.getLogger()
+
+ROOT = Path(__file__).resolve().parents[1]
+PRAW_INI = """[bot]
+client_id=bench
+client_secret=bench
+username=bench
+password=bench
+oauth_url={url}
+reddit_url={url}
+short_url={url}
+"""
+# extensions of the exported records (the json files only hold IDs)
+EXPORT_EXTENSIONS = [".csv", ".jsonl", ".parquet", ".sqlite", ".xlsx"]
+
+
+def benchmarks(subreddit, posts, users, sample):
+    """
+    Command line of each benchmarked script, by name
+    """
+    urls = ",".join(
+        f"https://www.reddit.com/r/{subreddit}/comments/{base36(POST_BASE + i)}/bench/"
+        for i in range(0, posts, max(posts // sample, 1))
+    )
+    usernames = ",".join(f"user_{i}" for i in range(min(users, 2)))
+    return {
+        "fetch_posts_subreddit": [
+            "fetch_posts_subreddit.py",
+            "-s",
+            subreddit,
+            "-a",
+            "1500000000",
+            "-b",
+            "1600000001",
+            "--delay",
+            "0",
+        ],
+        "download_comments_post": [
+            "download_comments_post.py",
+            "-u",
+            urls,
+            "--rate_limit",
+            "0",
+        ],
+        "download_comments_user": [
+            "download_comments_user.py",
+            "-u",
+            usernames,
+            "--rate_limit",
+            "0",
+        ],
+        "download_posts_user": [
+            "download_posts_user.py",
+            "-u",
+            usernames,
+            "--rate_limit",
+            "0",
+        ],
+        "psaw_download_posts_subreddit": [
+            "psaw/download_posts_subreddit.py",
+            "-s",
+            subreddit,
+        ],
+        "psaw_download_posts_terms": [
+            "psaw/download_posts_terms.py",
+            "-s",
+            "france",
+            "--subreddit",
+            subreddit,
+        ],
+        "psaw_download_comments_terms": [
+            "psaw/download_comments_terms.py",
+            "-s",
+            "france",
+            "--subreddit",
+            subreddit,
+        ],
+        "psaw_download_posts_user": ["psaw/download_posts_user.py", "-u", usernames],
+        "psaw_download_comments_user": [
+            "psaw/download_comments_user.py",
+            "-u",
+            usernames,
+        ],
+    }
+
+
+def server_requests(url):
+    with urlopen(f"{url}/_stats") as response:
+        return json.load(response)["requests"]
+
+
+def count_records(folder):
+    """
+    Number of rows of the files exported in folder
+    """
+    rows = 0
+    for path in Path(folder).rglob("*"):
+        if path.suffix not in EXPORT_EXTENSIONS:
+            continue
+        if path.suffix == ".csv":
+            rows += len(pd.read_csv(path, sep="\t"))
+        elif path.suffix == ".jsonl":
+            rows += len(pd.read_json(path, lines=True))
+        elif path.suffix == ".parquet":
+            rows += len(pd.read_parquet(path))
+        elif path.suffix == ".sqlite":
+            with sqlite3.connect(path) as connection:
+                tables = connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'"
+                ).fetchall()
+                for (table,) in tables:
+                    rows += connection.execute(
+                        f'SELECT COUNT(*) FROM "{table}"'
+                    ).fetchone()[0]
+        else:
+            rows += len(pd.read_excel(path))
+    return rows
+
+
+def wait_process(process, timeout):
+    """
+    Wait for process, killing it after timeout seconds, and return its exit
+    code with its resource usage (peak RSS included)
+    """
+    deadline = time.time() + timeout
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.time() > deadline:
+            logger.warning("Killing %s after %s seconds", process.args[1], timeout)
+            process.kill()
+            _, status, usage = os.wait4(process.pid, 0)
+            break
+        time.sleep(0.05)
+    # already reaped, Popen must not wait for it again
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage
+
+
+def run_script(name, command, url, export_format, timeout):
+    """
+    Run one script in a fresh folder and return its measures
+    """
+    with tempfile.TemporaryDirectory(prefix=f"bench_{name}_") as folder:
+        with open(Path(folder) / "praw.ini", "w") as f:
+            f.write(PRAW_INI.format(url=url))
+        env = dict(os.environ, PUSHSHIFT_URL=url)
+        command = [
+            sys.executable,
+            str(ROOT / command[0]),
+            *command[1:],
+            "--export_format",
+            export_format,
+        ]
+        logger.debug(" ".join(command))
+        requests_before = server_requests(url)
+        start = time.time()
+        with open(Path(folder) / "stderr.log", "w+b") as stderr:
+            process = subprocess.Popen(
+                command, cwd=folder, env=env, stdout=subprocess.DEVNULL, stderr=stderr
+            )
+            returncode, usage = wait_process(process, timeout)
+            stderr.seek(0)
+            error = stderr.read().decode("utf-8", "replace").strip()[-2000:]
+        runtime = time.time() - start
+        requests = server_requests(url) - requests_before
+        result = {
+            "script": name,
+            "returncode": returncode,
+            "runtime": round(runtime, 3),
+            "requests": requests,
+            "requests/s": round(requests / runtime, 1),
+            # kilobytes on Linux
+            "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        }
+        if returncode != 0:
+            result["error"] = error
+            return result
+        records = count_records(folder)
+        result["records"] = records
+        result["records/s"] = round(records / runtime, 1)
+        return result
+
+
+def main(args):
+    reddit = SyntheticReddit(
+        subreddit=args.subreddit,
+        posts=args.posts,
+        comments=args.comments,
+        users=args.users,
+    )
+    server = start_server(
+        reddit, latency=args.latency / 1000, page_limit=args.page_limit
+    )
+    logger.info("Mock server listening on %s", server.url)
+
+    commands = benchmarks(args.subreddit, args.posts, args.users, args.sample)
+    names = list(commands)
+    if args.scripts is not None:
+        names = [x.strip() for x in args.scripts.split(",")]
+        unknown = set(names) - set(commands)
+        if unknown:
+            logger.error("Unknown scripts : %s. Use %s", unknown, ", ".join(commands))
+            exit()
+
+    results = []
+    for name in names:
+        logger.info("Running %s", name)
+        result = run_script(
+            name, commands[name], server.url, args.export_format, args.timeout
+        )
+        if "error" in result:
+            logger.error("%s failed :\n%s", name, result["error"])
+        results.append(result)
+    server.shutdown()
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+    report = pd.DataFrame(results).drop(columns="error", errors="ignore")
+    print(report.to_string(index=False))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the scripts against a local mock of Pushshift and Reddit"
+    )
+    parser.add_argument(
+        "--debug",
+        help="Display debugging information",
+        action="store_const",
+        dest="loglevel",
+        const=logging.DEBUG,
+        default=logging.INFO,
+    )
+    parser.add_argument(
+        "--scripts",
+        type=str,
+        help="Scripts to run, separated by commas. Default : all",
+    )
+    parser.add_argument(
+        "-s", "--subreddit", type=str, help="Default : bench", default="bench"
+    )
+    parser.add_argument(
+        "--posts", type=int, help="Number of posts. Default : 2000", default=2000
+    )
+    parser.add_argument(
+        "--comments",
+        type=int,
+        help="Average number of comments per post. Default : 20",
+        default=20,
+    )
+    parser.add_argument(
+        "--users", type=int, help="Number of users. Default : 50", default=50
+    )
+    parser.add_argument(
+        "--sample",
+        type=int,
+        help="Number of posts given to download_comments_post. Default : 20",
+        default=20,
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        help="Milliseconds added to each response. Default : 0",
+        default=0,
+    )
+    parser.add_argument(
+        "--page_limit",
+        type=int,
+        help="Maximum number of results of a Pushshift request. Default : 1000",
+        default=1000,
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Seconds before a script is killed. Default : 600",
+        default=600,
+    )
+    parser.add_argument(
+        "--export_format",
+        type=str,
+        help="Export format of the scripts (csv, jsonl, parquet or sqlite). Default : csv",
+        default="csv",
+    )
+    parser.add_argument(
+        "--json", type=str, help="Also write the results to this JSON file"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.loglevel)
+    return args
+
+
+if __name__ == "__main__":
+    main(parse_args())
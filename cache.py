@@ -0,0 +1,186 @@
+"""
+On-disk cache of HTTP responses, shared by the Pushshift calls and praw.
+
+Responses are stored in files named after the hash of their URL, expire
+after a TTL depending on the endpoint, and the least recently used ones
+are removed when the cache grows over its maximum size. Only the GET
+requests to the endpoints of TTLS are cached : listings (new posts,
+streams, user histories) and /api/info (the number of comments read by
+--incremental) change from one request to the next, and POST requests
+(/api/morechildren) are always sent.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import requests
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+logger = logging.getLogger()
+
+HOUR = 3600
+DAY = 24 * HOUR
+# TTL of the responses, by regex on the URL (first match wins), the other
+# URLs are not cached
+TTLS = [
+    (re.compile(r"/reddit/search/"), 7 * DAY),
+    # the comments of a post, not the /r/<subreddit>/comments/ listing
+    (re.compile(r"/comments/\w+"), HOUR),
+]
+MAX_SIZE = 1024**3
+# headers describing the raw body, which is stored decoded, and the rate
+# limit state of the time of the request
+DROPPED_HEADERS = (
+    "content-encoding",
+    "content-length",
+    "transfer-encoding",
+    "x-ratelimit",
+)
+# reason of the responses served from the cache
+CACHED_REASON = "OK (cached)"
+
+
+class ResponseCache:
+    """
+    Directory of cached responses, each file holding a JSON line of
+    metadata followed by the body
+    """
+
+    def __init__(self, directory, max_size=MAX_SIZE, ttls=TTLS):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.ttls = ttls
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = sum(f.stat().st_size for f in self._files())
+
+    def _files(self):
+        return (f for f in self.directory.glob("*/*") if not f.name.endswith(".tmp"))
+
+    def _path(self, url):
+        key = hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()
+        return self.directory / key[:2] / key
+
+    def ttl(self, url):
+        """
+        Return the TTL of the responses of url, None if they are not cached
+        """
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return None
+
+    def get(self, url):
+        """
+        Return (metadata, body) of the cached response of url, None if it is
+        missing or expired
+        """
+        path = self._path(url)
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if time.time() - meta["stored"] > self.ttl(url):
+            self.misses += 1
+            return None
+        # the modification time is the last use, for the LRU eviction
+        os.utime(path)
+        self.hits += 1
+        return meta, body
+
+    def set(self, url, status, headers, body):
+        path = self._path(url)
+        path.parent.mkdir(exist_ok=True)
+        meta = {
+            "url": url,
+            "status": status,
+            "headers": {
+                k: v
+                for k, v in headers.items()
+                if not k.lower().startswith(DROPPED_HEADERS)
+            },
+            "stored": time.time(),
+        }
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(meta).encode("utf-8") + b"\n")
+            f.write(body)
+        old_size = path.stat().st_size if path.exists() else 0
+        os.replace(tmp, path)
+        with self._lock:
+            self._size += path.stat().st_size - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used responses until the cache is back
+        under 90% of its maximum size
+        """
+        files = sorted(
+            ((f.stat().st_mtime, f.stat().st_size, f) for f in self._files()),
+            key=lambda x: x[0],
+        )
+        removed = 0
+        for _, size, f in files:
+            if self._size <= self.max_size * 0.9:
+                break
+            f.unlink(missing_ok=True)
+            self._size -= size
+            removed += 1
+        logger.debug("%s responses evicted from the cache", removed)
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    Transport adapter answering GET requests from a ResponseCache
+    """
+
+    def __init__(self, cache, *args, **kwargs):
+        self.cache = cache
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if request.method != "GET" or self.cache.ttl(request.url) is None:
+            return super().send(request, **kwargs)
+        cached = self.cache.get(request.url)
+        if cached is not None:
+            meta, body = cached
+            response = requests.Response()
+            response.status_code = meta["status"]
+            response.headers.update(meta["headers"])
+            response._content = body
+            response.url = request.url
+            response.request = request
+            response.reason = CACHED_REASON
+            response.encoding = requests.utils.get_encoding_from_headers(
+                response.headers
+            )
+            return response
+        response = super().send(request, **kwargs)
+        if response.status_code == 200:
+            self.cache.set(
+                request.url, response.status_code, response.headers, response.content
+            )
+        return response
+
+
+def normalize_url(url):
+    """
+    Sort the query parameters, so that the same request always gives the
+    same key
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit(parts._replace(query=query))
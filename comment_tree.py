@@ -0,0 +1,187 @@
+"""
+Array-backed comment trees, built from an export of download_comments_post.
+
+The comments of all the threads are held in numpy arrays, indexed by their
+row : parent row, depth, preorder position and subtree size. Everything is
+computed one depth level at a time, without any per-comment Python loop,
+so that millions of comments can be processed.
+
+    tree = CommentTree.from_frame(pd.read_csv("comments.csv", sep="\\t"))
+    metrics = tree.frame()
+"""
+
+import numpy as np
+import pandas as pd
+
+# prefix of the fullnames of the parents which are comments
+COMMENT_PREFIX = "t1_"
+
+
+class CommentTree:
+    """
+    Forest of the comments of one or several threads.
+
+    parent holds the row of the parent of each comment (-1 for the top-level
+    comments, or when the parent is missing from the data). In preorder,
+    the subtree of a comment is the range [position, position + size) of
+    its thread.
+    """
+
+    def __init__(self, ids, parent, thread, created):
+        self.ids = np.asarray(ids)
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.thread = np.asarray(thread)
+        self.created = np.asarray(created, dtype=np.float64)
+        self.depth = tree_depth(self.parent)
+        self.root = tree_root(self.parent, self.depth)
+        self.size = subtree_size(self.parent, self.depth)
+        self.position = preorder_position(
+            self.parent, self.depth, self.size, self.thread
+        )
+
+    @classmethod
+    def from_frame(
+        cls,
+        df,
+        id_column="ID",
+        parent_column="Parent",
+        thread_column="Post ID",
+        date_column="Date",
+    ):
+        """
+        Build the trees of the comments of an export
+        """
+        ids = df[id_column].astype(str).to_numpy()
+        parents = df[parent_column].astype(str)
+        # only the parents which are comments have a row
+        parent_ids = parents.str.slice(len(COMMENT_PREFIX)).where(
+            parents.str.startswith(COMMENT_PREFIX)
+        )
+        parent = pd.Index(ids).get_indexer(parent_ids)
+        if thread_column in df.columns:
+            thread = pd.factorize(df[thread_column])[0]
+        else:
+            thread = np.zeros(len(df), dtype=np.int64)
+        dates = pd.to_datetime(df[date_column])
+        created = ((dates - pd.Timestamp(0)) / pd.Timedelta(seconds=1)).to_numpy()
+        return cls(ids, parent, thread, created)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def reply_latency(self):
+        """
+        Seconds between each comment and its parent comment (NaN for the
+        top-level comments)
+        """
+        latency = np.full(len(self), np.nan)
+        replies = self.parent >= 0
+        latency[replies] = self.created[replies] - self.created[self.parent[replies]]
+        return latency
+
+    def descendants_per_root(self):
+        """
+        Number of descendants of each top-level comment, by ID
+        """
+        roots = self.parent < 0
+        return pd.Series(self.size[roots] - 1, index=self.ids[roots])
+
+    def preorder(self):
+        """
+        Rows of the comments sorted by thread, then in preorder
+        """
+        return np.lexsort((self.position, self.thread))
+
+    def frame(self):
+        """
+        Dataframe of the tree of each comment, in the rows of the input
+        """
+        latency = self.reply_latency
+        return pd.DataFrame(
+            {
+                "Position": self.position,
+                "Parent Position": np.where(
+                    self.parent >= 0, self.position[self.parent], -1
+                ),
+                "Depth": self.depth,
+                "Subtree Size": self.size,
+                "Root ID": self.ids[self.root],
+                "Reply Latency": latency,
+            }
+        )
+
+
+def tree_depth(parent):
+    """
+    Depth of each node (0 for the roots), resolved one level at a time
+    """
+    depth = np.where(parent < 0, 0, -1)
+    level = 0
+    while True:
+        pending = np.flatnonzero(depth < 0)
+        if not len(pending):
+            return depth
+        ready = pending[depth[parent[pending]] == level]
+        if not len(ready):
+            raise ValueError("Cycle in the parents of the comments")
+        level += 1
+        depth[ready] = level
+
+
+def tree_root(parent, depth):
+    """
+    Row of the top-level ancestor of each node
+    """
+    root = np.arange(len(parent))
+    for level in range(1, depth.max(initial=0) + 1):
+        nodes = np.flatnonzero(depth == level)
+        root[nodes] = root[parent[nodes]]
+    return root
+
+
+def subtree_size(parent, depth):
+    """
+    Number of nodes of the subtree of each node (itself included), summed
+    from the deepest level up
+    """
+    size = np.ones(len(parent), dtype=np.int64)
+    for level in range(depth.max(initial=0), 0, -1):
+        nodes = np.flatnonzero(depth == level)
+        np.add.at(size, parent[nodes], size[nodes])
+    return size
+
+
+def preorder_position(parent, depth, size, thread):
+    """
+    Position of each node in the preorder of its thread, siblings keeping
+    the order of their rows
+    """
+    position = np.zeros(len(parent), dtype=np.int64)
+    for level in range(depth.max(initial=0) + 1):
+        nodes = np.flatnonzero(depth == level)
+        # siblings share a parent, the roots of a thread share the thread
+        group = thread[nodes] if level == 0 else parent[nodes]
+        nodes = nodes[np.argsort(group, kind="stable")]
+        group = thread[nodes] if level == 0 else parent[nodes]
+        # sizes of the previous siblings
+        before = np.cumsum(size[nodes]) - size[nodes]
+        first = np.r_[True, group[1:] != group[:-1]]
+        before -= np.maximum.accumulate(np.where(first, before, 0))
+        if level == 0:
+            position[nodes] = before
+        else:
+            position[nodes] = position[parent[nodes]] + 1 + before
+    return position
+
+
+def with_tree(df, **columns):
+    """
+    Return df sorted by thread then in preorder, with the tree columns of
+    CommentTree.frame (columns gives the column names of from_frame)
+    """
+    tree = CommentTree.from_frame(df, **columns)
+    order = tree.preorder()
+    tree_df = tree.frame().iloc[order].reset_index(drop=True)
+    df = df.iloc[order].reset_index(drop=True)
+    return pd.concat([df, tree_df], axis=1)
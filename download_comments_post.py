@@ -4,77 +4,311 @@ Download comment from posts by IDs or URLs and export it to xlsx or csv
 """
 
 import praw
+from praw.models import Submission
 import argparse
 import time
 import json
 import logging
 import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from tqdm import tqdm
 
+import metrics
+import transport
+from comment_tree import with_tree
+from more_comments import expand_comments
+from records import (
+    COMMENT_FIELDS,
+    NORMALIZED_COLUMNS,
+    Columns,
+    comments_frame,
+    select_fields,
+)
+from storage import (
+    STREAM_FORMATS,
+    categorize,
+    iter_chunks,
+    iter_frame_chunks,
+    merge_export,
+    open_writer,
+    read_dataframe,
+    read_index,
+    read_state,
+    write_dataframe,
+    write_state,
+)
+
 logger = logging.getLogger()
-STARTTIME = time.time()
+# /api/info accepts at most 100 fullnames per request
+INFO_BATCH_SIZE = 100
+# columns of the posts export, with --normalize
+POST_COLUMNS = [
+    "Post ID",
+    "Subreddit",
+    "Post Date",
+    "Post Title",
+    "Post Author",
+    "Post URL",
+    "Post Permalink",
+    "Comments",
+]
+# fields of the comments, the columns of their post coming from the submission
+FIELDS = select_fields(
+    COMMENT_FIELDS, [x for x in NORMALIZED_COLUMNS if x != "Post ID"]
+)
 
 
 def main(args):
+    metrics.configure(
+        "download_comments_post",
+        path=args.metrics_file,
+        interval=args.metrics_interval,
+    )
+    if args.stream and args.export_format not in STREAM_FORMATS:
+        logger.error("--stream only supports these export formats : %s", STREAM_FORMATS)
+        exit()
+    if args.incremental and args.file is None:
+        logger.error("--incremental needs the previous export given by --file")
+        exit()
+    if args.incremental and args.export_format == "sqlite":
+        # the rows go to the shared database, without a file to keep the
+        # state next to
+        logger.error("--incremental doesn't support the sqlite export format")
+        exit()
+
+    # one session and one request budget for all the workers
+    transport.configure(
+        pool_size=max(transport.POOL_SIZE, args.workers),
+        cache_dir=args.cache_dir,
+        rate_limit=args.rate_limit,
+    )
     reddit = redditconnect("bot")
+    if args.workers > 1:
+        # get the access token before the workers all ask for one
+        reddit.auth.scopes()
 
     folder = "Comments"
 
+    # sidecar index of the previous export, sparing its full reload
+    index = None
+    df_orig = None
     if args.file is not None:
-        if args.import_format == "xlsx":
-            df_orig = pd.read_excel(args.file)
+        if args.import_format == args.export_format:
+            index = read_index(args.file, args.import_format)
+        if index is None:
+            df_orig = read_dataframe(args.file, args.import_format)
             logger.debug(list(df_orig))
-        else:
-            df_orig = pd.read_csv(args.file, sep="\t", encoding="utf-8")
 
-    df = pd.DataFrame()
+    # (post_id, url) of each post to extract
     if args.source is not None:
         with open(args.source, "r") as f:
-            data = json.load(f)
-        for post_id in tqdm(data, dynamic_ncols=True):
-            logger.info("Extracting comments for id %s", post_id)
-            df = df.append(fetch_comments(reddit, post_id=post_id))
+            posts = [(post_id, None) for post_id in json.load(f)]
     elif args.id is not None:
-        ids = [x.strip() for x in args.id.split(",")]
-        for post_id in tqdm(ids, dynamic_ncols=True):
-            logger.info("Extracting comments for id %s", post_id)
-            df = df.append(fetch_comments(reddit, post_id=post_id))
+        posts = [(x.strip(), None) for x in args.id.split(",")]
     elif args.urls is not None:
-        urls = [x.strip() for x in args.urls.split(",")]
-        for url in tqdm(urls, dynamic_ncols=True):
-            logger.info("Extracting comments for url %s", url)
-            df = df.append(fetch_comments(reddit, url=url))
+        posts = [(None, x.strip()) for x in args.urls.split(",")]
     else:
         logger.error("Error in arguments. Use --source,-i/--id or -u/--url")
         exit()
 
-    df["Date"] = pd.to_datetime(df["Date"], unit="s")
-
-    if args.file is not None:
-        df_orig = df_orig[~df_orig["ID"].isin(df["ID"])]
-        df = df_orig.append(df)
+    # the posts of the normalized export, by ID
+    post_rows = {} if args.normalize else None
+    # number of comments and newest comment of each extracted post
+    state = {}
+    watermarks = {}
+    if args.incremental:
+        previous = read_state(args.file) or {}
+        posts, watermarks = changed_posts(reddit, posts, previous)
+        state.update(previous)
 
     Path(folder).mkdir(parents=True, exist_ok=True)
 
-    filename = f"{folder}/comments_{int(time.time())}"
-    if args.export_format == "xlsx":
-        writer = pd.ExcelWriter(
-            f"{filename}.xlsx",
-            engine="xlsxwriter",
-            options={"strings_to_urls": False},
-        )
-        df.to_excel(writer, sheet_name="Sheet1")
-        writer.save()
+    timestamp = int(time.time())
+    filename = f"{folder}/comments_{timestamp}"
+    expand = {
+        "max_depth": args.max_depth,
+        "min_more_size": args.min_more_size,
+        "max_requests": args.max_requests_per_post,
+        "workers": args.more_workers,
+    }
+    frames = iter_comment_frames(
+        reddit,
+        posts,
+        workers=args.workers,
+        state=state,
+        watermarks=watermarks,
+        expand=expand,
+        post_rows=post_rows,
+        tree=args.tree,
+    )
+    if args.stream:
+        writer = open_writer(filename, args.export_format, indexed=True)
+        ids = set()
+        for df in iter_frame_chunks(frames, args.chunk_size):
+            if args.normalize:
+                df = categorize(df)
+            with metrics.phase("export"):
+                writer.write(df)
+            ids.update(df["ID"])
+        # the IDs extracted again are only known now : as in every export,
+        # the previous comments go after the new ones
+        with metrics.phase("export"):
+            if index is not None:
+                merge_export(writer, args.file, index, ids)
+            elif df_orig is not None:
+                writer.write(df_orig[~df_orig["ID"].isin(ids)])
+            writer.close()
     else:
-        df.to_csv(f"{filename}.csv", index=False, sep="\t")
+        # a single concat, the frames of the posts are never copied one by one
+        frames = [df for df in frames if not df.empty]
+        if frames:
+            df = pd.concat(frames, ignore_index=True)
+        else:
+            df = comments_frame(Columns(FIELDS), normalize=args.normalize)
+            if args.tree:
+                df = with_tree(df)
+        if args.normalize:
+            df = categorize(df)
+
+        with metrics.phase("export"):
+            if index is not None:
+                writer = open_writer(filename, args.export_format, indexed=True)
+                writer.write(df)
+                # then the previous export, except the comments extracted again
+                merge_export(writer, args.file, index, set(df["ID"]))
+                writer.close()
+            else:
+                if df_orig is not None:
+                    df_orig = df_orig[~df_orig["ID"].isin(df["ID"])]
+                    df = pd.concat([df, df_orig])
+                write_dataframe(df, filename, args.export_format, indexed=True)
+    if post_rows is not None:
+        with metrics.phase("export"):
+            write_dataframe(
+                posts_frame(list(post_rows.values())),
+                f"{folder}/posts_{timestamp}",
+                args.export_format,
+                # the posts table of fetch_posts_subreddit has other columns
+                table="threads",
+            )
+    if args.export_format != "sqlite":
+        write_state(f"{filename}.{args.export_format}", state)
+
+    metrics.close()
+
+
+def changed_posts(reddit, posts, previous):
+    """
+    Return the posts whose number of comments changed since the state
+    previous, as (post_id, url) pairs, with the previous state of each of
+    them.
 
-    runtime = time.time() - STARTTIME
-    logger.info("Runtime : %.2f seconds" % runtime)
+    The numbers of comments are fetched by batches with /api/info.
+    """
+    ids = [to_post_id(post_id) or Submission.id_from_url(url) for post_id, url in posts]
+    counts = {}
+    for batch in iter_chunks(ids, INFO_BATCH_SIZE):
+        for submission in reddit.info(fullnames=[f"t3_{x}" for x in batch]):
+            counts[submission.id] = submission.num_comments
+    changed = [
+        (x, None)
+        for x in ids
+        if x not in previous or counts.get(x) != previous[x]["num_comments"]
+    ]
+    logger.info("%s/%s posts changed since the previous run", len(changed), len(ids))
+    watermarks = {x: previous[x] for x, _ in changed if x in previous}
+    return changed, watermarks
+
+
+def to_post_id(post_id):
+    """
+    Return the ID of a post given by ID or fullname (t3_xxxxx)
+    """
+    if post_id is None:
+        return None
+    post_id = str(post_id)
+    return post_id[3:] if post_id.startswith("t3_") else post_id
+
+
+def iter_comment_frames(
+    reddit,
+    posts,
+    workers=1,
+    state=None,
+    watermarks=None,
+    expand=None,
+    post_rows=None,
+    tree=False,
+):
+    """
+    Yield the comments dataframe of each (post_id, url) of posts, in the
+    order of posts.
+
+    The posts are extracted by workers threads sharing the same Reddit
+    instance. At most 2 * workers extracted posts wait to be yielded.
+    The state of each post is stored in state, watermarks holds the
+    previous state of the posts to refresh, and expand the limits given to
+    expand_comments. With post_rows, the export is normalized, and with
+    tree the comments get their tree columns (see fetch_comments).
+    """
+    watermarks = watermarks or {}
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        with tqdm(total=len(posts), dynamic_ncols=True) as pbar:
+            for post_id, url in posts:
+                pending.append(
+                    executor.submit(
+                        fetch_comments,
+                        reddit,
+                        url=url,
+                        post_id=post_id,
+                        state=state,
+                        watermark=watermarks.get(post_id),
+                        expand=expand,
+                        post_rows=post_rows,
+                        tree=tree,
+                    )
+                )
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+                    pbar.update()
+            while pending:
+                yield pending.popleft().result()
+                pbar.update()
+
+
+def posts_frame(rows):
+    """
+    Build the posts dataframe of the normalized export
+    """
+    df = pd.DataFrame(rows, columns=POST_COLUMNS)
+    df["Post Date"] = pd.to_datetime(df["Post Date"], unit="s")
+    return categorize(df)
 
 
-def fetch_comments(reddit, url=None, post_id=None):
-    comments = []
+def fetch_comments(
+    reddit,
+    url=None,
+    post_id=None,
+    state=None,
+    watermark=None,
+    expand=None,
+    post_rows=None,
+    tree=False,
+):
+    """
+    Return the comments dataframe of a post.
+
+    With the watermark (previous state) of the post, only the comments
+    newer than its newest comment are returned. The state of the post is
+    stored in state, expand holds the limits given to expand_comments.
+    With post_rows, the post is stored in it instead of being repeated in
+    each comment row. With tree, the comments are sorted in preorder, with
+    the columns of comment_tree.CommentTree.frame.
+    """
+    expand = dict(expand or {})
     if post_id:
         submission = reddit.submission(id=post_id)
     elif url:
@@ -82,47 +316,81 @@ def fetch_comments(reddit, url=None, post_id=None):
     else:
         logger.error("Error in fetch_comments")
         exit()
+    logger.info("Extracting comments for %s", post_id or url)
 
-    submission = reddit.submission(url=url)
-    submission.comments.replace_more(limit=None)
-    for index, comment in enumerate(submission.comments.list(), 1):
-        if not comment.author:
-            author = "[deleted]"
-        else:
-            author = comment.author.name
-        comments.append(
-            {
-                "ID": comment.id,
-                "Subreddit": comment.subreddit.display_name,
-                "Date": comment.created_utc,
-                "Author": author,
-                "Comment": comment.body,
-                "Score": comment.score,
-                "Length": len(comment.body),
-                "Gilded": comment.gilded,
-                "Parent": comment.parent_id,
-                "Flair": comment.author_flair_text,
-                "Post ID": submission.id,
-                "Post Permalink": f"https://reddit.com{submission.permalink}",
-                "Post Title": submission.title,
-                "Post Author": submission.author,
-                "Post URL": submission.url,
-                "Permalink": f"https://reddit.com{comment.permalink}",
-            }
+    if watermark is not None and "newest_id" not in watermark:
+        # no comment at the previous run
+        watermark = None
+    if watermark is not None:
+        # the newest comments are the ones loaded with the submission, and
+        # the hidden ones older than the watermark are not expanded
+        submission.comment_sort = "new"
+        expand["newer_than"] = watermark["newest_id"]
+    with metrics.phase("comments"):
+        comment_list = expand_comments(reddit, submission, **expand)
+    metrics.count("comments_fetched", len(comment_list))
+    if state is not None:
+        state[submission.id] = post_state(submission, comment_list, watermark)
+    if watermark is not None:
+        comment_list = [
+            comment
+            for comment in comment_list
+            if int(comment.id, 36) > int(watermark["newest_id"], 36)
+        ]
+    post = {
+        "Post ID": submission.id,
+        "Post Permalink": f"https://reddit.com{submission.permalink}",
+        "Post Title": submission.title,
+        "Post Author": str(submission.author),
+        "Post URL": submission.url,
+    }
+    if post_rows is not None:
+        post_rows[submission.id] = dict(
+            post,
+            **{
+                "Subreddit": submission.subreddit.display_name,
+                "Post Date": submission.created_utc,
+                "Comments": submission.num_comments,
+            },
         )
+        post = {"Post ID": submission.id}
+    comments = Columns(FIELDS).extend(comment_list)
 
-    df = pd.DataFrame(comments)
-
+    df = comments_frame(comments, normalize=post_rows is not None, post=post)
+    if tree:
+        with metrics.phase("dataframe"):
+            df = with_tree(df)
     return df
 
 
+def post_state(submission, comments, watermark=None):
+    """
+    State of a post : its number of comments, and the date and ID of its
+    newest comment
+    """
+    newest = max(comments, key=lambda x: int(x.id, 36), default=None)
+    if newest is None:
+        return dict(watermark or {}, num_comments=submission.num_comments)
+    if watermark is not None and int(watermark["newest_id"], 36) > int(newest.id, 36):
+        return dict(watermark, num_comments=submission.num_comments)
+    return {
+        "num_comments": submission.num_comments,
+        "newest": newest.created_utc,
+        "newest_id": newest.id,
+    }
+
+
 def redditconnect(bot):
     """
     Fonction de connexion à reddit
     """
     user_agent = "python:script:download_comments_post"
 
-    reddit = praw.Reddit("bot", user_agent=user_agent)
+    reddit = praw.Reddit(
+        "bot",
+        user_agent=user_agent,
+        requestor_kwargs={"session": transport.get_session()},
+    )
     return reddit
 
 
@@ -160,16 +428,92 @@ def parse_args():
         type=str,
         help="The name of the file containing comments already extracted",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of posts extracted concurrently. Default : 1",
+        default=1,
+    )
+    parser.add_argument(
+        "--more_workers",
+        type=int,
+        help="Number of concurrent requests expanding the comments of a post. Default : 4",
+        default=4,
+    )
+    parser.add_argument(
+        "--max_depth",
+        type=int,
+        help="Depth from which the hidden comments are not expanded (no limit by default)",
+    )
+    parser.add_argument(
+        "--min_more_size",
+        type=int,
+        help="Minimum number of hidden comments worth an expansion request. Default : 0",
+        default=0,
+    )
+    parser.add_argument(
+        "--max_requests_per_post",
+        type=int,
+        help="Maximum number of expansion requests per post (no limit by default)",
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=float,
+        help="Maximum number of Reddit requests per minute, shared by the workers (0 for no limit). Default : 100",
+        default=100,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Only extract the posts whose number of comments changed since the export given by --file, and only their new comments",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Folder where the HTTP responses are cached (no cache by default)",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        help="JSON file where the metrics of the run are written, with a Prometheus textfile next to it (.prom)",
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        type=float,
+        help="Seconds between two writes of the metrics file. Default : 60",
+        default=60,
+    )
     parser.add_argument(
         "--export_format",
         type=str,
-        help="Export format (csv or xlsx). Default : csv",
+        help="Export format (csv, xlsx, jsonl, parquet or sqlite). Default : csv",
         default="csv",
     )
+    parser.add_argument(
+        "--normalize",
+        help="Export the posts once, in a separate posts table linked to the comments by Post ID",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tree",
+        help="Sort the comments of each post in preorder and add their tree columns (Position, Parent Position, Depth, Subtree Size, Root ID, Reply Latency)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream",
+        help="Export the comments by chunks while fetching them (csv, jsonl, parquet or sqlite)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        help="Number of comments per chunk, if used with --stream. Default : 10000",
+        default=10000,
+    )
     parser.add_argument(
         "--import_format",
         type=str,
-        help="Import format, if used with --file (csv or xlsx). Default : csv",
+        help="Import format, if used with --file (csv, xlsx or parquet). Default : csv",
         default="csv",
     )
 
@@ -8,34 +8,62 @@ import argparse
 import time
 import logging
 import pandas as pd
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
 
+import transport
+from records import COMMENT_FIELDS, Columns, select_fields
+from storage import write_dataframe
+
 logger = logging.getLogger()
 temps_debut = time.time()
+# columns of the comments export
+COLUMNS = [
+    "User",
+    "ID",
+    "Comment",
+    "Permalink",
+    "Length",
+    "Date",
+    "Score",
+    "Subreddit",
+    "Gilded",
+    "Post ID",
+    "Post Title",
+    "Post URL",
+    "Post Author",
+]
+# fields of the comments export, the posts being given by their fullname
+FIELDS = dict(
+    select_fields(COMMENT_FIELDS, COLUMNS), **{"Post ID": attrgetter("link_id")}
+)
 
 
 def main(args):
+    # one session and one request budget for all the workers
+    transport.configure(
+        pool_size=max(transport.POOL_SIZE, args.workers),
+        cache_dir=args.cache_dir,
+        rate_limit=args.rate_limit,
+    )
+    reddit = redditconnect("bot")
+    if args.workers > 1:
+        # get the access token before the workers all ask for one
+        reddit.auth.scopes()
     folder = "User"
     Path(folder).mkdir(parents=True, exist_ok=True)
 
-    username = [x.strip() for x in args.username.split(",")]
+    username = list(dict.fromkeys(x.strip() for x in args.username.split(",")))
 
-    for i in tqdm(username):
+    # each user is exported as soon as their comments are fetched
+    for i, future in iter_users(reddit, username, args.workers):
         try:
-            df = fetch_comments(i)
+            df = future.result()
             df["Date"] = pd.to_datetime(df["Date"], unit="s")
             filename = f"{folder}/comments_{int(time.time())}_{i}"
-            if args.export_format == "xlsx":
-                writer = pd.ExcelWriter(
-                    f"{filename}.xlsx",
-                    engine="xlsxwriter",
-                    options={"strings_to_urls": False},
-                )
-                df.to_excel(writer, sheet_name="Sheet1")
-                writer.save()
-            else:
-                df.to_csv(f"{filename}.csv", index=False, sep="\t")
+            write_dataframe(df, filename, args.export_format)
         except Exception as e:
             logger.error(
                 "Does that user have made any comment ? Complete error : %s", e
@@ -44,37 +72,34 @@ def main(args):
     logger.info("Runtime : %.2f seconds" % (time.time() - temps_debut))
 
 
-def fetch_comments(username):
-    reddit = redditconnect("bot")
-    user = reddit.redditor(username)
-    comments = []
+def iter_users(reddit, usernames, workers=1):
+    """
+    Fetch the comments of usernames with workers threads sharing the same
+    Reddit instance, and yield (username, future) as each user finishes
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch_comments, reddit, username): username
+            for username in usernames
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            yield futures[future], future
+
+
+def fetch_comments(reddit, username):
     user = reddit.redditor(username)
-    for index, comment in enumerate(user.comments.new(limit=None), 1):
-        comments.append(
-            {
-                "User": str(username),
-                "ID": comment.id,
-                "Comment": comment.body,
-                "Permalink": f"https://reddit.com{comment.permalink}",
-                "Length": len(comment.body),
-                "Date": comment.created_utc,
-                "Score": comment.score,
-                "Subreddit": comment.subreddit.display_name,
-                "Gilded": comment.gilded,
-                "Post ID": comment.link_id,
-                "Post Title": comment.link_title,
-                "Post URL": comment.link_url,
-                "Post Author": comment.link_author,
-            }
-        )
-    df = pd.DataFrame(comments)
-    return df
+    comments = Columns(FIELDS).extend(user.comments.new(limit=None))
+    return comments.frame(COLUMNS, constants={"User": str(username)})
 
 
 def redditconnect(bot):
     user_agent = "python:script:download_comments_user"
 
-    reddit = praw.Reddit(bot, user_agent=user_agent)
+    reddit = praw.Reddit(
+        bot,
+        user_agent=user_agent,
+        requestor_kwargs={"session": transport.get_session()},
+    )
     return reddit
 
 
@@ -97,10 +122,27 @@ def parse_args():
         help="The users to download comments from (separated by commas)",
         required=True,
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of users fetched concurrently. Default : 4",
+        default=4,
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=float,
+        help="Maximum number of Reddit requests per minute, shared by the workers (0 for no limit). Default : 100",
+        default=100,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Folder where the HTTP responses are cached (no cache by default)",
+    )
     parser.add_argument(
         "--export_format",
         type=str,
-        help="Export format (csv or xlsx). Default : csv",
+        help="Export format (csv, xlsx, parquet or sqlite). Default : csv",
         default="csv",
     )
     args = parser.parse_args()
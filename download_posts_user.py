@@ -8,81 +8,104 @@ import argparse
 import time
 import logging
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
 
+import transport
+from records import POST_FIELDS, Columns, select_fields
+from storage import write_dataframe
+
 logger = logging.getLogger()
 temps_debut = time.time()
+# columns of the posts export
+COLUMNS = [
+    "ID",
+    "Title",
+    "URL",
+    "Comments",
+    "Score",
+    "Ratio",
+    "Author",
+    "Author CSS Flair",
+    "Author Text Flair",
+    "Permalink",
+    "Date",
+    "Flair",
+    "Text",
+    "Domain",
+    "Gilded",
+    "Hidden",
+    "Archived",
+    "Can Gild",
+    "Can Crosspost",
+    "Subreddit",
+]
+# fields of the posts export
+FIELDS = select_fields(POST_FIELDS, COLUMNS)
 
 
 def main(args):
+    # one session and one request budget for all the workers
+    transport.configure(
+        pool_size=max(transport.POOL_SIZE, args.workers),
+        cache_dir=args.cache_dir,
+        rate_limit=args.rate_limit,
+    )
+    reddit = redditconnect("bot")
+    if args.workers > 1:
+        # get the access token before the workers all ask for one
+        reddit.auth.scopes()
     folder = "User"
     Path(folder).mkdir(parents=True, exist_ok=True)
 
     if args.username:
-        username = [x.strip() for x in args.username.split(",")]
+        username = list(dict.fromkeys(x.strip() for x in args.username.split(",")))
     else:
         logger.error("Use -u to set the username")
         exit()
 
-    for i in tqdm(username):
+    # each user is exported as soon as their posts are fetched
+    for i, future in iter_users(reddit, username, args.workers):
         try:
-            df = fetch_posts(i)
+            df = future.result()
             df["Date"] = pd.to_datetime(df["Date"], unit="s")
             filename = f"{folder}/posts_{int(time.time())}_{i}"
-            if args.export_format == "xlsx":
-                writer = pd.ExcelWriter(
-                    f"{filename}.xlsx",
-                    engine="xlsxwriter",
-                    options={"strings_to_urls": False},
-                )
-                df.to_excel(writer, sheet_name="Sheet1")
-                writer.save()
-            else:
-                df.to_csv(f"{filename}.csv", index=False, sep="\t")
+            write_dataframe(df, filename, args.export_format)
         except Exception as e:
             logger.error("Does that user have made any post ? Complete error : %s", e)
 
     logger.info("Runtime : %.2f seconds" % (time.time() - temps_debut))
 
 
-def fetch_posts(username):
-    reddit = redditconnect("bot")
-    posts = []
+def iter_users(reddit, usernames, workers=1):
+    """
+    Fetch the posts of usernames with workers threads sharing the same
+    Reddit instance, and yield (username, future) as each user finishes
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch_posts, reddit, username): username
+            for username in usernames
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            yield futures[future], future
+
+
+def fetch_posts(reddit, username):
     user = reddit.redditor(username)
-    for index, submission in enumerate(user.submissions.new(limit=None), 1):
-        posts.append(
-            {
-                "ID": submission.name,
-                "Title": submission.title,
-                "URL": submission.url,
-                "Comments": submission.num_comments,
-                "Score": submission.score,
-                "Ratio": submission.upvote_ratio,
-                "Author": str(submission.author),
-                "Author CSS Flair": str(submission.author_flair_css_class),
-                "Author Text Flair": str(submission.author_flair_text),
-                "Permalink": f"https://reddit.com{submission.permalink}",
-                "Date": submission.created_utc,
-                "Flair": str(submission.link_flair_text),
-                "Text": str(submission.selftext),
-                "Domain": submission.domain,
-                "Gilded": submission.gilded,
-                "Hidden": submission.hidden,
-                "Archived": submission.archived,
-                "Can Gild": submission.can_gild,
-                "Can Crosspost": submission.is_crosspostable,
-                "Subreddit": submission.subreddit.display_name,
-            }
-        )
-    df = pd.DataFrame(posts)
-    return df
+    posts = Columns(FIELDS).extend(user.submissions.new(limit=None))
+    return posts.frame(COLUMNS)
 
 
 def redditconnect(bot):
     user_agent = "python:script:download_posts_user"
 
-    reddit = praw.Reddit(bot, user_agent=user_agent)
+    reddit = praw.Reddit(
+        bot,
+        user_agent=user_agent,
+        requestor_kwargs={"session": transport.get_session()},
+    )
     return reddit
 
 
@@ -105,10 +128,27 @@ def parse_args():
         help="The users to download posts from (separated by commas)",
         required=True,
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of users fetched concurrently. Default : 4",
+        default=4,
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=float,
+        help="Maximum number of Reddit requests per minute, shared by the workers (0 for no limit). Default : 100",
+        default=100,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Folder where the HTTP responses are cached (no cache by default)",
+    )
     parser.add_argument(
         "--export_format",
         type=str,
-        help="Export format (csv or xlsx). Default : csv",
+        help="Export format (csv, xlsx, parquet or sqlite). Default : csv",
         default="csv",
     )
     args = parser.parse_args()
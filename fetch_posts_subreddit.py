@@ -7,53 +7,104 @@ import argparse
 import logging
 import time
 import json
-import requests
 import praw
-import xlsxwriter
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from pathlib import Path
 
+import metrics
+import transport
+from follow import StreamPosition, follow
+from journal import Journal
+from pushshift import SUBMISSION_SEARCH_URL, crawl
+from records import (
+    COMMENT_FIELDS,
+    POST_FIELDS,
+    Columns,
+    comments_frame,
+    iter_column_chunks,
+    select_fields,
+)
+from storage import (
+    STREAM_FORMATS,
+    merge_export,
+    open_writer,
+    read_dataframe,
+    read_index,
+    write_dataframe,
+)
+
 logger = logging.getLogger()
 STARTTIME = time.time()
-
-
-def getPushshiftData(before, after, sub):
-    url = (
-        "https://api.pushshift.io/reddit/search/submission?&size=1000&after="
-        + str(after)
-        + "&subreddit="
-        + str(sub)
-        + "&before="
-        + str(before)
-    )
-    iter = 0
-    while True:
-        iter += 1
-        time.sleep(3)
-        req = requests.get(url)
-        # allow 5 fails before exiting
-        if req.status_code != 502 or iter > 5:
-            break
-    try:
-        data = json.loads(req.text)
-    except Exception as e:
-        breakpoint()
-    # with open('export_pushshift.json', 'w') as f:
-    #     json.dump(data['data'], f)
-    return data["data"]
+# /api/info accepts at most 100 fullnames per request
+INFO_BATCH_SIZE = 100
+# columns of the posts export
+COLUMNS = [
+    "ID",
+    "Title",
+    "Date",
+    "Score",
+    "Ratio",
+    "Comments",
+    "Flair",
+    "Domain",
+    "Text",
+    "URL",
+    "Permalink",
+    "Author",
+    "Author CSS Flair",
+    "Author Text Flair",
+    "Gilded",
+    "Can Gild",
+    "Hidden",
+    "Archived",
+    "Can Crosspost",
+]
+# fields of the posts export, the text of the posts without tabs
+FIELDS = dict(
+    select_fields(POST_FIELDS, COLUMNS),
+    Text=lambda x: str(x.selftext).replace("\r", "\n").replace("\t", " "),
+)
 
 
 def main(args):
     # export folder
     export_folder = "Subreddit"
-    # list of post ID's
-    post_ids = []
-
     df_orig = None
 
+    if args.stream and args.export_format not in STREAM_FORMATS:
+        logger.error("--stream only supports these export formats : %s", STREAM_FORMATS)
+        exit()
+
+    metrics.configure(
+        "fetch_posts_subreddit",
+        path=args.metrics_file,
+        interval=args.metrics_interval,
+    )
+    transport.configure(
+        pool_size=args.pool_size or args.workers, cache_dir=args.cache_dir
+    )
     reddit = redditconnect("bot")
 
+    if args.follow:
+        if args.export_format not in STREAM_FORMATS:
+            logger.error(
+                "--follow only supports these export formats : %s", STREAM_FORMATS
+            )
+            exit()
+        follow_subreddit(
+            reddit,
+            args.subreddit,
+            export_folder,
+            args.export_format,
+            comments=args.follow_comments,
+            flush_records=args.flush_records,
+            flush_seconds=args.flush_seconds,
+        )
+        metrics.close()
+        return
+
     # lowest timestamp of extracted data
     if args.after is not None:
         after = int(args.after)
@@ -66,26 +117,46 @@ def main(args):
     else:
         before = int(STARTTIME) - 600000
 
+    # sidecar index of the previous export, sparing its full reload
+    index = None
     if args.file is not None:
-        if args.import_format == "xlsx":
-            df_orig = pd.read_excel(args.file)
+        if args.import_format == args.export_format:
+            index = read_index(args.file, args.import_format)
+        if index is not None:
+            logger.debug("Index of %s found", args.file)
+            datemax = pd.to_datetime(index["date_max"], unit="s")
         else:
-            df_orig = pd.read_csv(args.file, sep="\t", encoding="utf-8")
-        logger.debug("#### LIST ####")
-        logger.debug(list(df_orig))
-        logger.debug("#### INFO ####")
-        df_orig["Date"] = pd.to_datetime(df_orig["Date"])
-        datemax = df_orig["Date"].max()
+            df_orig = read_dataframe(args.file, args.import_format)
+            logger.debug("#### LIST ####")
+            logger.debug(list(df_orig))
+            logger.debug("#### INFO ####")
+            df_orig["Date"] = pd.to_datetime(df_orig["Date"])
+            datemax = df_orig["Date"].max()
         logger.debug("datemax = " + str(datemax))
         datemax = pd.to_datetime(datemax, unit="s")
         # ~ 7 jours
         moins7j = pd.to_datetime(before - 600000, unit="s")
         if datemax >= moins7j:
             datemax = moins7j
-        df_orig = df_orig[df_orig["Date"] <= datemax]
+        if df_orig is not None:
+            df_orig = df_orig[df_orig["Date"] <= datemax]
         # on enlève de df tout ce qui va être extrait
         after = int(datemax.timestamp())
 
+    journal = Journal(
+        f"{export_folder}/posts_{args.subreddit}.journal", resume=args.resume
+    )
+    started = journal.records_of("start")
+    if started:
+        # the default before depends on the current time : keep the window
+        # of the interrupted crawl
+        after, before = started[0]["after"], started[0]["before"]
+        logger.info("Resuming crawl of %s-%s", after, before)
+    else:
+        journal.write({"type": "start", "after": after, "before": before})
+    # fullnames of the batches whose request failed
+    failed = []
+
     if args.source is None:
         logger.debug("Begin extracting Pushshift data")
         logger.debug(
@@ -94,20 +165,22 @@ def main(args):
             str(after),
             str(args.subreddit),
         )
-        data = getPushshiftData(before, after, args.subreddit)
-
-        # Will run until all posts have been gathered
-        # from the 'after' date up until todays date
-        while len(data) > 0:
-            for submission in data:
-                post_ids.append(submission["id"])
-            logger.debug("timestamp = " + str(data[-1]["created_utc"]))
-            # Calls getPushshiftData() with the created date of the last submission
-            data = getPushshiftData(before, data[-1]["created_utc"], args.subreddit)
+        with metrics.phase("paging"):
+            results = crawl(
+                SUBMISSION_SEARCH_URL,
+                {"subreddit": args.subreddit},
+                after,
+                before,
+                shards=args.shards,
+                workers=args.workers,
+                journal=journal,
+                delay=args.delay,
+                fields=["id"],
+            )
+        data = [x["id"] for x in results]
+        metrics.count("posts_found", len(data))
         logger.debug("Extracting Pushshift data DONE.")
 
-        data = post_ids
-
     else:
         logger.debug("ID file detected")
         with open(args.source, "r") as f:
@@ -119,87 +192,237 @@ def main(args):
     # ID export
     export(data, export_folder, filename_without_ext, export_type="json")
 
-    # Extract posts
-    df = pd.DataFrame()
-    df = fetch_posts(data, reddit)
+    if args.stream or index is not None:
+        writer = open_writer(
+            f"{export_folder}/{filename_without_ext}", args.export_format, indexed=True
+        )
+        if args.stream:
+            # Extract and export posts chunk by chunk
+            chunks = iter_post_chunks(
+                data, reddit, args.chunk_size, journal=journal, failed=failed
+            )
+        else:
+            chunks = [fetch_posts(data, reddit, journal=journal, failed=failed)]
+        ids = set()
+        for df in chunks:
+            with metrics.phase("export"):
+                writer.write(df)
+            ids.update(df["ID"])
+        # the previous posts go after the new ones, except the ones extracted
+        # again
+        with metrics.phase("export"):
+            if index is not None:
+                merge_export(writer, args.file, index, ids, date_max=after)
+            elif df_orig is not None:
+                writer.write(df_orig[~df_orig["ID"].isin(ids)])
+            writer.close()
+    else:
+        # Extract posts
+        df = fetch_posts(data, reddit, journal=journal, failed=failed)
+
+        # Create the complete dataframe if df_orig exists
+        if df_orig is not None:
+            df_orig = df_orig[~df_orig["ID"].isin(df["ID"])]
+            df = pd.concat([df, df_orig])
+
+        # Posts export
+        with metrics.phase("export"):
+            export(
+                df, export_folder, filename_without_ext, export_type=args.export_format
+            )
+    if failed:
+        # keep the journal, a --resume run requests the failed batches again
+        logger.error(
+            "%s posts could not be requested, run again with --resume to fetch them",
+            len(failed),
+        )
+    journal.close(remove=not failed)
 
-    # Create the complete dataframe if df_orig exists
-    if df_orig is not None:
-        df_orig = df_orig[~df_orig["ID"].isin(df["ID"])]
-        df = df_orig.append(df)
+    metrics.close()
 
-    # Posts export
-    export(df, export_folder, filename_without_ext, export_type=args.export_format)
 
-    runtime = time.time() - STARTTIME
-    print("Runtime : %.2f seconds" % runtime)
+def follow_subreddit(
+    reddit,
+    subreddit,
+    folder,
+    export_format,
+    comments=False,
+    flush_records=100,
+    flush_seconds=10,
+):
+    """
+    Export the posts (and comments) of subreddit as they are submitted,
+    by micro-batches, until interrupted
+    """
+    timestamp = int(time.time())
+    writers = {
+        "submissions": open_writer(
+            f"{folder}/posts_{subreddit}_{timestamp}", export_format, indexed=True
+        )
+    }
+    frames = {"submissions": lambda x: posts_frame(Columns(FIELDS).extend(x))}
+    if comments:
+        writers["comments"] = open_writer(
+            f"{folder}/comments_{subreddit}_{timestamp}", export_format, indexed=True
+        )
+        frames["comments"] = lambda x: comments_frame(Columns(COMMENT_FIELDS).extend(x))
+
+    def sink(name):
+        def export(things):
+            with metrics.phase("export"):
+                writers[name].write(frames[name](things))
+
+        return export
+
+    try:
+        follow(
+            reddit.subreddit(subreddit),
+            {name: sink(name) for name in writers},
+            StreamPosition(f"{folder}/posts_{subreddit}"),
+            max_records=flush_records,
+            max_seconds=flush_seconds,
+        )
+    finally:
+        for writer in writers.values():
+            writer.close()
 
 
-def fetch_posts(data, reddit):
+def fetch_posts(data, reddit, journal=None, failed=None):
     """
     Extrait les commentaires du subreddit subreddit entre les timestamp \
     beginningtime et endtime. Renvoie un dataframe panda
     """
-    columns = [
-        "ID",
-        "Title",
-        "Date",
-        "Score",
-        "Ratio",
-        "Comments",
-        "Flair",
-        "Domain",
-        "Text",
-        "URL",
-        "Permalink",
-        "Author",
-        "Author CSS Flair",
-        "Author Text Flair",
-        "Gilded",
-        "Can Gild",
-        "Hidden",
-        "Archived",
-        "Can Crosspost",
-    ]
-    df = []
-    for x in tqdm(data, dynamic_ncols=True):
-        try:
-            submission = reddit.submission(id=str(x))
-            df.append(
-                {
-                    "Score": submission.score,
-                    "Author": str(submission.author),
-                    "Author CSS Flair": str(submission.author_flair_css_class),
-                    "Author Text Flair": str(submission.author_flair_text),
-                    "Ratio": submission.upvote_ratio,
-                    "ID": submission.name,
-                    "Permalink": f"https://reddit.com{submission.permalink}",
-                    "Title": submission.title,
-                    "URL": submission.url,
-                    "Comments": submission.num_comments,
-                    "Date": submission.created_utc,
-                    "Flair": str(submission.link_flair_text),
-                    "Text": str(submission.selftext)
-                    .replace("\r", "\n")
-                    .replace("\t", " "),
-                    "Domain": submission.domain,
-                    "Gilded": submission.gilded,
-                    "Hidden": submission.hidden,
-                    "Archived": submission.archived,
-                    "Can Gild": submission.can_gild,
-                    "Can Crosspost": submission.is_crosspostable,
-                }
-            )
-        except Exception as e:
-            print("Error : " + str(e))
-    logger.debug("Fetching posts DONE.")
-    logger.debug("Creating pandas dataframe…")
-    df = pd.DataFrame(df)
-    df["Date"] = pd.to_datetime(df["Date"], unit="s")
-    df = df[columns]
+    posts = Columns(FIELDS)
+    for batch in iter_posts(data, reddit, journal=journal, failed=failed):
+        posts.update(batch.columns)
+    df = posts_frame(posts)
+    logger.debug("Creating pandas dataframe DONE.")
+    return df
+
+
+def iter_post_chunks(data, reddit, chunk_size, journal=None, failed=None):
+    """
+    Same as fetch_posts, but yield dataframes of at most chunk_size posts
+    as soon as they are hydrated
+    """
+    batches = iter_posts(data, reddit, journal=journal, failed=failed)
+    for posts in iter_column_chunks(batches, FIELDS, chunk_size):
+        yield posts_frame(posts)
+
+
+def posts_frame(posts):
+    """
+    Build the export dataframe of the Columns of posts
+    """
+    with metrics.phase("dataframe"):
+        df = posts.frame(COLUMNS)
+        df["Date"] = pd.to_datetime(df["Date"], unit="s")
     return df
 
 
+def iter_posts(data, reddit, journal=None, failed=None):
+    """
+    Yield the Columns of the posts of a list of post IDs, by batch.
+
+    Each hydrated batch is written to the journal, batches already in it
+    are not requested again. The fullnames of the batches whose request
+    failed are added to failed, and left out of the journal.
+    """
+    missing = []
+    hydrated = set()
+    if journal is not None:
+        for record in journal.records_of("batch"):
+            columns = record.get("columns")
+            if columns is None:
+                # journal of an older version, with a dict per post
+                columns = {x: [row[x] for row in record["rows"]] for x in FIELDS}
+            yield Columns(FIELDS, columns)
+            missing.extend(record["missing"])
+            hydrated.update(record["ids"])
+        logger.debug("%s posts already in the journal", len(hydrated))
+    data = [x for x in data if to_fullname(x) not in hydrated]
+
+    with tqdm(total=len(data), dynamic_ncols=True) as pbar:
+        for batch, submissions, batch_missing in hydrate_submissions(reddit, data):
+            pbar.update(len(batch))
+            if submissions is None:
+                if failed is not None:
+                    failed.extend(batch)
+                metrics.count("posts_failed", len(batch))
+                continue
+            with metrics.phase("dataframe"):
+                posts = Columns(FIELDS).extend(submissions)
+            if journal is not None:
+                journal.write(
+                    {
+                        "type": "batch",
+                        "ids": batch,
+                        "columns": posts.columns,
+                        "missing": batch_missing,
+                    }
+                )
+            yield posts
+            missing.extend(batch_missing)
+            metrics.count("posts_hydrated", len(posts))
+            metrics.count("posts_missing", len(batch_missing))
+    if missing:
+        logger.warning(
+            "%s posts could not be fetched (removed or invalid) : %s",
+            len(missing),
+            ", ".join(missing),
+        )
+    logger.debug("Fetching posts DONE.")
+
+
+def to_fullname(post_id):
+    """
+    Return the fullname (t3_xxxxx) of a post ID
+    """
+    post_id = str(post_id)
+    if post_id.startswith("t3_"):
+        return post_id
+    return f"t3_{post_id}"
+
+
+def fetch_info(reddit, fullnames):
+    """
+    Fetch one batch of submissions with a single /api/info request
+    """
+    with metrics.phase("hydration"):
+        return list(reddit.info(fullnames=fullnames))
+
+
+def hydrate_submissions(reddit, data, batch_size=INFO_BATCH_SIZE):
+    """
+    Fetch the submissions of a list of post IDs by batches of fullnames.
+
+    The next batch is requested while the current one is processed.
+    Yields (batch, submissions, missing) for each batch, missing being the
+    fullnames /api/info didn't return (removed, deleted or invalid IDs).
+    submissions is None if the request of the batch failed.
+    """
+    batches = [
+        [to_fullname(x) for x in data[i : i + batch_size]]
+        for i in range(0, len(data), batch_size)
+    ]
+    if not batches:
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_future = executor.submit(fetch_info, reddit, batches[0])
+        for index, batch in enumerate(batches):
+            future = next_future
+            if index + 1 < len(batches):
+                next_future = executor.submit(fetch_info, reddit, batches[index + 1])
+            try:
+                submissions = future.result()
+            except Exception as e:
+                logger.error("Error fetching batch %s : %s", batch[0], e)
+                yield batch, None, []
+                continue
+            found = {submission.name for submission in submissions}
+            yield batch, submissions, [x for x in batch if x not in found]
+
+
 def export(data, folder, filename, export_type):
     """
     Fonction d'export
@@ -213,18 +436,8 @@ def export(data, folder, filename, export_type):
         # export json
         with open(f"{folder}/{filename}.json", "w") as f:
             json.dump(data, f)
-    elif export_type == "xlsx":
-        writer = pd.ExcelWriter(
-            f"{filename}.xlsx",
-            engine="xlsxwriter",
-            options={"strings_to_urls": False},
-        )
-        logger.debug("df.to_excel")
-        data.to_excel(writer, sheet_name="Sheet1", index=False)
-        logger.debug("writer.save")
-        writer.save()
-    elif export_type == "csv":
-        data.to_csv(f"{folder}/{filename}.csv", index=False, sep="\t")
+    else:
+        write_dataframe(data, f"{folder}/{filename}", export_type, indexed=True)
 
 
 def redditconnect(bot):
@@ -233,7 +446,11 @@ def redditconnect(bot):
     """
     user_agent = "python:script:download_posts_subreddit"
 
-    reddit = praw.Reddit(bot, user_agent=user_agent)
+    reddit = praw.Reddit(
+        bot,
+        user_agent=user_agent,
+        requestor_kwargs={"session": transport.get_session()},
+    )
     logger.debug(reddit.user.me())
     return reddit
 
@@ -261,6 +478,29 @@ def parse_args():
     parser.add_argument(
         "-b", "--before", type=str, help="The max unixstamp to download"
     )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="Number of time windows the Pushshift crawl is split in, if the server can't count the posts by day. Default : 16",
+        default=16,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of concurrent Pushshift requests. Default : 4",
+        default=4,
+    )
+    parser.add_argument(
+        "--delay",
+        type=float,
+        help="Seconds to wait before each Pushshift request. Default : 3",
+        default=3,
+    )
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        help="Number of HTTP connections kept open per host. Default : --workers",
+    )
     parser.add_argument(
         "--source",
         type=str,
@@ -271,16 +511,70 @@ def parse_args():
         type=str,
         help="The name of the file containing posts already extracted",
     )
+    parser.add_argument(
+        "--resume",
+        help="Resume an interrupted crawl from its journal",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--follow",
+        help="Instead of crawling Pushshift, export the new posts of the subreddit as they are submitted, until interrupted",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--follow_comments",
+        help="Also export the new comments of the subreddit, if used with --follow",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--flush_records",
+        type=int,
+        help="Number of new records exported at once, if used with --follow. Default : 100",
+        default=100,
+    )
+    parser.add_argument(
+        "--flush_seconds",
+        type=float,
+        help="Maximum seconds a new record waits before being exported, if used with --follow. Default : 10",
+        default=10,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Folder where the HTTP responses are cached (no cache by default)",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        help="JSON file where the metrics of the run are written, with a Prometheus textfile next to it (.prom)",
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        type=float,
+        help="Seconds between two writes of the metrics file. Default : 60",
+        default=60,
+    )
     parser.add_argument(
         "--export_format",
         type=str,
-        help="Export format (csv or xlsx). Default : csv",
+        help="Export format (csv, xlsx, jsonl, parquet or sqlite). Default : csv",
         default="csv",
     )
+    parser.add_argument(
+        "--stream",
+        help="Export the posts by chunks while fetching them (csv, jsonl, parquet or sqlite)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        help="Number of posts per chunk, if used with --stream. Default : 10000",
+        default=10000,
+    )
     parser.add_argument(
         "--import_format",
         type=str,
-        help="Import format, if used with --file (csv or xlsx). Default : csv",
+        help="Import format, if used with --file (csv, xlsx or parquet). Default : csv",
         default="csv",
     )
     args = parser.parse_args()
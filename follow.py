@@ -0,0 +1,161 @@
+"""
+Follow mode : the new submissions and comments of a subreddit are read from
+its streams and exported by micro-batches, every FLUSH_RECORDS records or
+FLUSH_SECONDS seconds.
+
+The position of each stream (its newest exported fullname) is saved after
+every flush, so that a restarted follower skips what it already exported.
+"""
+
+import logging
+import signal
+import time
+
+import metrics
+from storage import read_state, write_state
+
+logger = logging.getLogger()
+
+# records buffered before a flush
+FLUSH_RECORDS = 100
+# seconds before a non-empty buffer is flushed
+FLUSH_SECONDS = 10
+# seconds between two polls of streams without new items
+POLL_INTERVAL = 2
+
+
+class MicroBatcher:
+    """
+    Buffer of records passed to flush every max_records records, or when
+    the oldest buffered record waited max_seconds seconds
+    """
+
+    def __init__(self, flush, max_records=FLUSH_RECORDS, max_seconds=FLUSH_SECONDS):
+        self._flush = flush
+        self.max_records = max_records
+        self.max_seconds = max_seconds
+        self.records = []
+        self.since = None
+
+    def add(self, record):
+        if not self.records:
+            self.since = time.monotonic()
+        self.records.append(record)
+        if len(self.records) >= self.max_records:
+            self.flush()
+
+    def due(self):
+        return bool(self.records) and (
+            time.monotonic() - self.since >= self.max_seconds
+        )
+
+    def poll(self):
+        """
+        Flush the buffer if its oldest record waited long enough
+        """
+        if self.due():
+            self.flush()
+
+    def flush(self):
+        if not self.records:
+            return
+        records, self.records = self.records, []
+        self._flush(records)
+        metrics.count("follow_flushes")
+
+
+class StreamPosition:
+    """
+    Newest fullname exported from each stream, saved as the sidecar state
+    of path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.positions = read_state(path) or {}
+
+    def is_new(self, stream, thing):
+        # IDs are given in creation order
+        position = self.positions.get(stream)
+        return position is None or int(thing.id, 36) > int(position.split("_")[-1], 36)
+
+    def advance(self, stream, things):
+        newest = max(things, key=lambda x: int(x.id, 36))
+        if self.is_new(stream, newest):
+            self.positions[stream] = newest.fullname
+
+    def save(self):
+        write_state(self.path, self.positions)
+
+
+def follow(
+    subreddit,
+    sinks,
+    position,
+    max_records=FLUSH_RECORDS,
+    max_seconds=FLUSH_SECONDS,
+):
+    """
+    Follow the streams of subreddit until interrupted (Ctrl-C or SIGTERM).
+
+    sinks maps the name of each followed stream (submissions or comments)
+    to the function exporting a list of its items, called every max_records
+    items or max_seconds seconds. The items older than position are
+    skipped, and position is saved after each flush.
+    """
+    batchers = {}
+    streams = {}
+    for name, export in sinks.items():
+        batchers[name] = MicroBatcher(
+            flush_to(name, export, position),
+            max_records=max_records,
+            max_seconds=max_seconds,
+        )
+        # pause_after=-1 hands back control after every request
+        streams[name] = getattr(subreddit.stream, name)(
+            pause_after=-1, exception_handler=stream_error
+        )
+
+    signal.signal(signal.SIGTERM, interrupt)
+    logger.info("Following %s of r/%s", ", ".join(sinks), subreddit.display_name)
+    try:
+        while True:
+            found = False
+            for name, stream in streams.items():
+                for thing in stream:
+                    if thing is None:
+                        break
+                    if position.is_new(name, thing):
+                        found = True
+                        batchers[name].add(thing)
+                        metrics.count(f"follow_{name}")
+                batchers[name].poll()
+            if not found:
+                time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        logger.info("Stopping, flushing the buffered records")
+    finally:
+        for batcher in batchers.values():
+            batcher.flush()
+
+
+def flush_to(name, export, position):
+    def flush(things):
+        export(things)
+        position.advance(name, things)
+        position.save()
+        logger.debug("%s %s exported", len(things), name)
+
+    return flush
+
+
+def stream_error(exception):
+    """
+    Keep following after a failed request, the stream retries it
+    """
+    logger.warning("Stream request failed : %s", exception)
+    metrics.count("follow_errors")
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
@@ -0,0 +1,87 @@
+"""
+Append-only journal of the work done by a long crawl, used to resume it
+after a crash.
+"""
+
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+logger = logging.getLogger()
+
+
+class Journal:
+    """
+    JSON lines file, each line being a record of completed work.
+
+    Every record is flushed and synced to disk before write() returns, so
+    a crash loses at most the record being written.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.records = []
+        if resume:
+            self.records = self.read()
+            self._drop_partial_line()
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a" if resume else "w", encoding="utf-8")
+
+    def read(self):
+        """
+        Return the records already in the journal
+        """
+        records = []
+        if not self.path.exists():
+            return records
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # last line cut by the crash
+                    logger.warning("Ignoring truncated record in %s", self.path)
+                    break
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning("Ignoring invalid record in %s", self.path)
+        logger.debug("%s records read from %s", len(records), self.path)
+        return records
+
+    def _drop_partial_line(self):
+        """
+        Remove the last line of the journal if a crash cut it, so that the
+        next record starts on its own line
+        """
+        if not self.path.exists():
+            return
+        with open(self.path, "r+b") as f:
+            end = f.read().rfind(b"\n") + 1
+            if end < f.tell():
+                f.truncate(end)
+
+    def records_of(self, kind):
+        """
+        Return the records already in the journal of a given type
+        """
+        return [record for record in self.records if record["type"] == kind]
+
+    def write(self, record):
+        """
+        Append a record to the journal
+        """
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self, remove=False):
+        """
+        Close the journal, removing it once the crawl is complete
+        """
+        self._file.close()
+        if remove:
+            self.path.unlink()
@@ -0,0 +1,199 @@
+"""
+Metrics of a run : time spent in each phase and counters (HTTP requests,
+retries, error statuses, sleeps...).
+
+They are written as JSON and as a Prometheus textfile (for the textfile
+collector of node_exporter) periodically during the run and at exit.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger()
+
+# prefix of the Prometheus metric names
+PREFIX = "reddit_scraper"
+# seconds between two reports during a run
+REPORT_INTERVAL = 60
+
+
+class Metrics:
+    """
+    Phase timers and counters, safe to update from several threads.
+
+    The time of a phase is summed over the threads running it, so phases
+    running concurrently can add up to more than the runtime.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.started = time.time()
+        self.phases = defaultdict(float)
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] += elapsed
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "script": self.script,
+                "started": self.started,
+                "runtime": time.time() - self.started,
+                "phases": dict(sorted(self.phases.items())),
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.snapshot(), indent=4))
+
+    def write_prometheus(self, path):
+        snapshot = self.snapshot()
+        script = snapshot["script"]
+        lines = [
+            f"# HELP {PREFIX}_runtime_seconds Time since the start of the run",
+            f"# TYPE {PREFIX}_runtime_seconds gauge",
+            f'{PREFIX}_runtime_seconds{{script="{script}"}} {snapshot["runtime"]:.3f}',
+            f"# HELP {PREFIX}_phase_seconds Time spent in each phase of the run",
+            f"# TYPE {PREFIX}_phase_seconds counter",
+        ]
+        for phase, seconds in snapshot["phases"].items():
+            lines.append(
+                f'{PREFIX}_phase_seconds{{script="{script}",phase="{phase}"}} '
+                f"{seconds:.3f}"
+            )
+        for name, value in snapshot["counters"].items():
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            lines.append(f'{PREFIX}_{name}_total{{script="{script}"}} {value:g}')
+        write_atomic(path, "\n".join(lines) + "\n")
+
+    def summary(self):
+        snapshot = self.snapshot()
+        phases = ", ".join(f"{k} {v:.2f}s" for k, v in snapshot["phases"].items())
+        text = "Runtime : %.2f seconds" % snapshot["runtime"]
+        return f"{text} ({phases})" if phases else text
+
+
+class Reporter(threading.Thread):
+    """
+    Thread writing the metrics every interval seconds
+    """
+
+    def __init__(self, metrics, path, interval=REPORT_INTERVAL):
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        try:
+            self.metrics.write_json(self.path)
+            self.metrics.write_prometheus(prometheus_path(self.path))
+        except OSError as e:
+            logger.warning("Could not write the metrics to %s : %s", self.path, e)
+
+    def stop(self):
+        self._stopped.set()
+        self.report()
+
+
+_metrics = Metrics("reddit-scraper")
+_reporter = None
+_lock = threading.Lock()
+
+
+def configure(script, path=None, interval=REPORT_INTERVAL):
+    """
+    Start collecting the metrics of script.
+
+    With a path, they are written to it as JSON (and next to it as a
+    Prometheus textfile) every interval seconds and at exit.
+    """
+    global _metrics, _reporter
+    with _lock:
+        if _reporter is not None:
+            _reporter.stop()
+            _reporter = None
+        _metrics = Metrics(script)
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            _reporter = Reporter(_metrics, path, interval=interval)
+            _reporter.start()
+    return _metrics
+
+
+def get_metrics():
+    return _metrics
+
+
+def count(name, value=1):
+    _metrics.count(name, value)
+
+
+def phase(name):
+    return _metrics.phase(name)
+
+
+def stop():
+    """
+    Stop the periodic reports, writing the last one
+    """
+    global _reporter
+    with _lock:
+        if _reporter is not None:
+            _reporter.stop()
+            _reporter = None
+
+
+def close():
+    """
+    Write the final report and log the runtime of each phase
+    """
+    stop()
+    logger.info(_metrics.summary())
+
+
+def prometheus_path(path):
+    """
+    Path of the Prometheus textfile written next to a JSON metrics file
+    """
+    return str(Path(path).with_suffix(".prom"))
+
+
+def write_atomic(path, text):
+    """
+    Write text to path through a temporary file, so that a collector never
+    reads a partial file
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# an interrupted run still writes its last report
+atexit.register(stop)
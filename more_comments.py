@@ -0,0 +1,152 @@
+"""
+Expansion of the MoreComments of a submission by batched /api/morechildren
+requests.
+
+praw's replace_more sends one request per MoreComments object. Here the
+children IDs of all the MoreComments found at the same round are pooled in
+batches of MORECHILDREN_BATCH_SIZE IDs, and the batches are requested
+concurrently. Each round expands the MoreComments returned by the previous
+one, until none is left or a limit is reached.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from praw.const import API_PATH
+from praw.models import MoreComments
+
+import metrics
+
+logger = logging.getLogger()
+
+# /api/morechildren returns at most 100 children per request
+MORECHILDREN_BATCH_SIZE = 100
+
+
+def expand_comments(
+    reddit,
+    submission,
+    max_depth=None,
+    min_more_size=0,
+    max_requests=None,
+    workers=1,
+    newer_than=None,
+):
+    """
+    Return the flat list of the comments of submission, expanding its
+    MoreComments.
+
+    MoreComments hiding comments at max_depth or deeper, or hiding less than
+    min_more_size comments, are not expanded. At most max_requests requests are sent for
+    the expansion. With newer_than (a comment ID), the hidden comments
+    older than it are not requested : IDs are given in creation order.
+    """
+    comments = []
+    depths = {}
+    pending = []
+    collect(submission.comments, comments, depths, pending)
+
+    requests = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending:
+            mores = [
+                more
+                for more in pending
+                if expandable(more, depths, max_depth, min_more_size)
+            ]
+            metrics.count("more_skipped", len(pending) - len(mores))
+            pending = []
+            # "continue this thread" links have no children : praw loads the
+            # thread of their parent
+            continued = [more for more in mores if not more.children]
+            children = list(
+                dict.fromkeys(child for more in mores for child in more.children)
+            )
+            if newer_than is not None:
+                children = [x for x in children if int(x, 36) > int(newer_than, 36)]
+            calls = [(expand_thread, more) for more in continued] + [
+                (fetch_children, children[i : i + MORECHILDREN_BATCH_SIZE])
+                for i in range(0, len(children), MORECHILDREN_BATCH_SIZE)
+            ]
+            if max_requests is not None and requests + len(calls) > max_requests:
+                logger.debug(
+                    "Request limit of %s reached for %s, %s requests skipped",
+                    max_requests,
+                    submission.id,
+                    requests + len(calls) - max_requests,
+                )
+                calls = calls[: max(max_requests - requests, 0)]
+            if not calls:
+                break
+            requests += len(calls)
+            futures = [
+                executor.submit(function, reddit, submission, argument)
+                for function, argument in calls
+            ]
+            for future in futures:
+                collect(future.result(), comments, depths, pending)
+    metrics.count("morechildren_requests", requests)
+    return comments
+
+
+def expandable(more, depths, max_depth, min_more_size):
+    if more.children and more.count < min_more_size:
+        return False
+    if max_depth is None:
+        return True
+    return thing_depth(more, depths) < max_depth
+
+
+def thing_depth(thing, depths):
+    """
+    Depth of a comment, or of the comments hidden by a MoreComments, in the
+    submission : one more than the depth of its parent comment.
+
+    The depth given by reddit is only used when the parent wasn't collected
+    (top level comments) : in the thread loaded by a "continue this thread"
+    link, it is relative to the comment continued.
+    """
+    parent_depth = depths.get(thing.parent_id)
+    if parent_depth is not None:
+        return parent_depth + 1
+    depth = getattr(thing, "depth", None)
+    return 0 if depth is None else depth
+
+
+def collect(things, comments, depths, pending):
+    """
+    Add the comments of a forest (or flat list) of things to comments, and
+    their MoreComments to pending
+    """
+    stack = list(things)[::-1]
+    while stack:
+        thing = stack.pop()
+        if isinstance(thing, MoreComments):
+            pending.append(thing)
+            continue
+        if thing.fullname in depths:
+            continue
+        depths[thing.fullname] = thing_depth(thing, depths)
+        comments.append(thing)
+        stack.extend(list(thing.replies)[::-1])
+
+
+def fetch_children(reddit, submission, children):
+    """
+    Fetch one batch of comments with a single /api/morechildren request
+    """
+    return reddit.post(
+        API_PATH["morechildren"],
+        data={
+            "children": ",".join(children),
+            "link_id": submission.fullname,
+            "sort": submission.comment_sort,
+        },
+    )
+
+
+def expand_thread(reddit, submission, more):
+    """
+    Fetch the comments behind a "continue this thread" link
+    """
+    more.submission = submission
+    return more.comments()
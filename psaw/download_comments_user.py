@@ -3,17 +3,30 @@
 Download comments from one or several users and export it in xlsx or csv.
 """
 
-from psaw import PushshiftAPI
-
 # import praw
 import argparse
+import sys
 import time
 import logging
-import pandas as pd
 
 # from tqdm import tqdm
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from pushshift import (  # noqa: E402
+    CHUNK_SIZE,
+    COMMENT_SEARCH_URL,
+    crawl,
+    fields_of,
+    iter_frames,
+    psaw_api,
+    result_frame,
+    server_rate_limit,
+    time_span,
+)
+from storage import iter_chunks, write_frames  # noqa: E402
+from transport import RateLimiter  # noqa: E402
+
 logger = logging.getLogger()
 temps_debut = time.time()
 
@@ -74,7 +87,12 @@ COLUMNS = [
 
 
 def main(args):
-    api = PushshiftAPI()
+    # one request budget for all the workers of --deep
+    rate_limit = args.rate_limit
+    if rate_limit is None:
+        rate_limit = server_rate_limit()
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    api = psaw_api(limiter=limiter, rate_limit_per_minute=rate_limit or None)
     folder = "User"
     Path(folder).mkdir(parents=True, exist_ok=True)
 
@@ -86,22 +104,19 @@ def main(args):
 
     for i in username:
         try:
-            df = fetch_comments(api, i)
-            df["date_utc"] = pd.to_datetime(df["created_utc"], unit="s")
-            df["date"] = pd.to_datetime(df["created"], unit="s")
-            df["permalink"] = "https://old.reddit.com" + df["permalink"].astype(str)
-            df = df[df.columns.intersection(COLUMNS)]
-            filename = f"{folder}/comments_{int(time.time())}_{i}"
-            if args.export_format == "xlsx":
-                writer = pd.ExcelWriter(
-                    f"{filename}.xlsx",
-                    engine="xlsxwriter",
-                    options={"strings_to_urls": False},
+            if args.deep:
+                frames = fetch_comments_deep(
+                    api, i, args.shards, args.workers, limiter=limiter
                 )
-                df.to_excel(writer, sheet_name="Sheet1")
-                writer.save()
             else:
-                df.to_csv(f"{filename}.csv", index=False, sep="\t")
+                frames = iter_frames(fetch_comments(api, i), COLUMNS)
+            filename = f"{folder}/comments_{int(time.time())}_{i}"
+            # the comments are exported by chunks while they are fetched
+            rows = write_frames(
+                frames, filename, args.export_format, table="pushshift_comments"
+            )
+            if not rows:
+                logger.error("Does that user have made any comment ?")
         except Exception as e:
             logger.error(
                 "Does that user have made any comment ? Complete error : %s", e
@@ -111,9 +126,35 @@ def main(args):
 
 
 def fetch_comments(api, username):
-    res = api.search_comments(author=username)
-    df = pd.DataFrame([thing.d_ for thing in res])
-    return df
+    return api.search_comments(author=username, filter=fields_of(COLUMNS))
+
+
+def fetch_comments_deep(api, username, shards, workers, limiter=None):
+    """
+    Fetch the whole history of a user : the time between their oldest and
+    newest comments is split in shards fetched concurrently, and split again
+    where a shard holds more than one page of comments. Every request waits
+    for limiter. Yields the comments by dataframes of CHUNK_SIZE rows.
+    """
+    params = {"author": username}
+    span = time_span(COMMENT_SEARCH_URL, params, limiter=limiter)
+    if span is None:
+        return
+    first, last = span
+    results = crawl(
+        COMMENT_SEARCH_URL,
+        params,
+        first - 1,
+        last + 1,
+        shards=shards,
+        workers=workers,
+        limiter=limiter,
+        fields=fields_of(COLUMNS),
+    )
+    for chunk in iter_chunks(results, CHUNK_SIZE):
+        # local time, as psaw gives it
+        rows = [dict(x, created=x["created_utc"] - api.utc_offset_secs) for x in chunk]
+        yield result_frame(rows, COLUMNS)
 
 
 def parse_args():
@@ -135,10 +176,32 @@ def parse_args():
         help="The users to download comments from (separated by commas)",
         required=True,
     )
+    parser.add_argument(
+        "--deep",
+        help="Fetch the whole history of each user by time windows fetched concurrently, instead of paging it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="Number of time windows the history of a user is split in, if used with --deep and the server can't count the comments by day. Default : 16",
+        default=16,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of time windows fetched concurrently, if used with --deep. Default : 4",
+        default=4,
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=float,
+        help="Maximum number of Pushshift requests per minute, shared by the workers (0 for no limit). Default : the limit of the server",
+    )
     parser.add_argument(
         "--export_format",
         type=str,
-        help="Export format (csv or xlsx). Default : csv",
+        help="Export format (csv, xlsx, parquet or sqlite). Default : csv",
         default="csv",
     )
     args = parser.parse_args()
@@ -3,12 +3,24 @@
 Download posts from a subreddit and export it in xlsx or csv.
 """
 
-from psaw import PushshiftAPI
 import argparse
+import sys
 import time
 import logging
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
 from pathlib import Path
+from tqdm import tqdm
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from pushshift import (  # noqa: E402
+    fields_of,
+    iter_frames,
+    psaw_api,
+    server_rate_limit,
+)
+from storage import write_frames  # noqa: E402
+from transport import RateLimiter  # noqa: E402
 
 logger = logging.getLogger()
 temps_debut = time.time()
@@ -100,44 +112,87 @@ COLUMNS = [
 
 
 def main(args):
-    api = PushshiftAPI()
     folder = "Subreddit"
     Path(folder).mkdir(parents=True, exist_ok=True)
 
     if args.subreddit:
-        subreddit = [x.strip() for x in args.subreddit.split(",")]
+        subreddit = list(dict.fromkeys(x.strip() for x in args.subreddit.split(",")))
     else:
         logger.error("Use -s to set the subreddit")
         exit()
 
-    for i in subreddit:
-        try:
-            df = fetch_posts(api, i)
-            df["date_utc"] = pd.to_datetime(df["created_utc"], unit="s")
-            df["date"] = pd.to_datetime(df["created"], unit="s")
-            df["permalink"] = "https://old.reddit.com" + df["permalink"].astype(str)
-            df = df[df.columns.intersection(COLUMNS)]
-            filename = f"{folder}/posts_{i}_{int(time.time())}"
-            if args.export_format == "xlsx":
-                writer = pd.ExcelWriter(
-                    f"{filename}.xlsx",
-                    engine="xlsxwriter",
-                    options={"strings_to_urls": False},
-                )
-                df.to_excel(writer, sheet_name="Sheet1")
-                writer.save()
-            else:
-                df.to_csv(f"{filename}.csv", index=False, sep="\t")
-        except Exception as e:
-            logger.error("Complete error : %s", e)
+    # one request budget for all the subreddits crawled at once
+    rate_limit = args.rate_limit
+    if rate_limit is None:
+        rate_limit = server_rate_limit()
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    # lines of the progress bars of the running crawls
+    slots = Queue()
+    for slot in range(args.workers):
+        slots.put(slot + 1)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(
+                crawl_subreddit,
+                i,
+                folder,
+                args.export_format,
+                limiter,
+                rate_limit,
+                slots,
+            ): i
+            for i in subreddit
+        }
+        # each subreddit is exported as soon as it is crawled, a failed crawl
+        # doesn't stop the others
+        for future in tqdm(
+            as_completed(futures), total=len(futures), desc="subreddits", position=0
+        ):
+            i = futures[future]
+            try:
+                rows = future.result()
+                logger.info("%s posts exported for %s", rows, i)
+            except Exception as e:
+                failed.append(i)
+                logger.error("Crawl of %s failed. Complete error : %s", i, e)
+    if failed:
+        logger.error("%s subreddits failed : %s", len(failed), ", ".join(failed))
 
     logger.info("Runtime : %.2f seconds" % (time.time() - temps_debut))
 
 
+def crawl_subreddit(subreddit, folder, export_format, limiter, rate_limit, slots):
+    """
+    Export the posts of a subreddit with its own psaw instance and progress
+    bar, and return their number
+    """
+    api = psaw_api(limiter=limiter, rate_limit_per_minute=rate_limit or None)
+    slot = slots.get()
+    try:
+        posts = tqdm(
+            fetch_posts(api, subreddit),
+            desc=subreddit,
+            unit=" posts",
+            position=slot,
+            leave=False,
+            dynamic_ncols=True,
+        )
+        filename = f"{folder}/posts_{subreddit}_{int(time.time())}"
+        # the posts are exported by chunks while they are fetched
+        return write_frames(
+            iter_frames(posts, COLUMNS),
+            filename,
+            export_format,
+            table="pushshift_posts",
+        )
+    finally:
+        slots.put(slot)
+
+
 def fetch_posts(api, subreddit):
-    res = api.search_submissions(subreddit=subreddit)
-    df = pd.DataFrame([thing.d_ for thing in res])
-    return df
+    return api.search_submissions(subreddit=subreddit, filter=fields_of(COLUMNS))
 
 
 def parse_args():
@@ -153,12 +208,27 @@ def parse_args():
         default=logging.INFO,
     )
     parser.add_argument(
-        "-s", "--subreddit", type=str, help="Subreddit", required=True,
+        "-s",
+        "--subreddit",
+        type=str,
+        help="Subreddits (separated by commas)",
+        required=True,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of subreddits crawled concurrently. Default : 4",
+        default=4,
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=float,
+        help="Maximum number of Pushshift requests per minute, shared by the workers (0 for no limit). Default : the limit of the server",
     )
     parser.add_argument(
         "--export_format",
         type=str,
-        help="Export format (csv or xlsx). Default : csv",
+        help="Export format (csv, xlsx, parquet or sqlite). Default : csv",
         default="csv",
     )
     args = parser.parse_args()
@@ -3,13 +3,22 @@
 Download comments containing one or several terms in one or several subreddits and export it in xlsx or csv.
 """
 
-from psaw import PushshiftAPI
 import argparse
+import sys
 import time
 import logging
-import pandas as pd
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from pushshift import (  # noqa: E402
+    fields_of,
+    iter_term_frames,
+    search_terms,
+    server_rate_limit,
+)
+from storage import write_frames  # noqa: E402
+from transport import RateLimiter  # noqa: E402
+
 logger = logging.getLogger()
 temps_debut = time.time()
 
@@ -100,38 +109,48 @@ COLUMNS = [
 
 
 def main(args):
-    api = PushshiftAPI()
     folder = "Search"
     Path(folder).mkdir(parents=True, exist_ok=True)
 
     if not args.search_terms:
         logger.error("Use -s to set search terms")
         exit()
-    df = fetch_comments(api, args.search_terms, args.subreddit)
-    df["date_utc"] = pd.to_datetime(df["created_utc"], unit="s")
-    df["date"] = pd.to_datetime(df["created"], unit="s")
-    df["permalink"] = "https://old.reddit.com" + df["permalink"].astype(str)
-    df = df[df.columns.intersection(COLUMNS)]
+    terms = list(dict.fromkeys(x.strip() for x in args.search_terms.split(",")))
+    subreddits = list(dict.fromkeys(x.strip() for x in args.subreddit.split(",")))
+
+    # one request budget for all the queries
+    rate_limit = args.rate_limit
+    if rate_limit is None:
+        rate_limit = server_rate_limit()
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    results, matched = search_terms(
+        fetch_posts,
+        terms,
+        subreddits,
+        workers=args.workers,
+        limiter=limiter,
+        rate_limit=rate_limit,
+    )
+
     filename = f"{folder}/comments_{int(time.time())}_{args.search_terms}"
-    if args.export_format == "xlsx":
-        writer = pd.ExcelWriter(
-            f"{filename}.xlsx", engine="xlsxwriter", options={"strings_to_urls": False},
-        )
-        df.to_excel(writer, sheet_name="Sheet1")
-        writer.save()
-    else:
-        df.to_csv(f"{filename}.csv", index=False, sep="\t")
+    rows = write_frames(
+        iter_term_frames(results, matched, terms, COLUMNS),
+        filename,
+        args.export_format,
+        table="pushshift_posts",
+    )
+    if not rows:
+        logger.warning("No posts found.")
 
     logger.info("Runtime : %.2f seconds" % (time.time() - temps_debut))
 
 
-def fetch_comments(api, search_terms, subreddit=None):
+def fetch_posts(api, search_term, subreddit=None):
     if not subreddit:
-        res = api.search_submissions(q=search_terms)
-    else:
-        res = api.search_submissions(q=search_terms, subreddit=subreddit)
-    df = pd.DataFrame([thing.d_ for thing in res])
-    return df
+        return api.search_submissions(q=search_term, filter=fields_of(COLUMNS))
+    return api.search_submissions(
+        q=search_term, subreddit=subreddit, filter=fields_of(COLUMNS)
+    )
 
 
 def parse_args():
@@ -159,10 +178,21 @@ def parse_args():
         help="Subreddit to search into (separated by commas)",
         required=True,
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of searches (term and subreddit) run concurrently. Default : 4",
+        default=4,
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=float,
+        help="Maximum number of Pushshift requests per minute, shared by the workers (0 for no limit). Default : the limit of the server",
+    )
     parser.add_argument(
         "--export_format",
         type=str,
-        help="Export format (csv or xlsx). Default : csv",
+        help="Export format (csv, xlsx, parquet or sqlite). Default : csv",
         default="csv",
     )
     args = parser.parse_args()
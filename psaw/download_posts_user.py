@@ -3,13 +3,16 @@
 Download posts from one or several users and export it in xlsx or csv.
 """
 
-from psaw import PushshiftAPI
 import argparse
+import sys
 import time
 import logging
-import pandas as pd
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from pushshift import fields_of, iter_frames, psaw_api  # noqa: E402
+from storage import write_frames  # noqa: E402
+
 logger = logging.getLogger()
 temps_debut = time.time()
 
@@ -100,7 +103,7 @@ COLUMNS = [
 
 
 def main(args):
-    api = PushshiftAPI()
+    api = psaw_api()
     folder = "User"
     Path(folder).mkdir(parents=True, exist_ok=True)
 
@@ -112,22 +115,16 @@ def main(args):
 
     for i in username:
         try:
-            df = fetch_posts(api, i)
-            df["date_utc"] = pd.to_datetime(df["created_utc"], unit="s")
-            df["date"] = pd.to_datetime(df["created"], unit="s")
-            df["permalink"] = "https://old.reddit.com" + df["permalink"].astype(str)
-            df = df[df.columns.intersection(COLUMNS)]
             filename = f"{folder}/posts_{int(time.time())}_{i}"
-            if args.export_format == "xlsx":
-                writer = pd.ExcelWriter(
-                    f"{filename}.xlsx",
-                    engine="xlsxwriter",
-                    options={"strings_to_urls": False},
-                )
-                df.to_excel(writer, sheet_name="Sheet1")
-                writer.save()
-            else:
-                df.to_csv(f"{filename}.csv", index=False, sep="\t")
+            # the posts are exported by chunks while they are fetched
+            rows = write_frames(
+                iter_frames(fetch_posts(api, i), COLUMNS),
+                filename,
+                args.export_format,
+                table="pushshift_posts",
+            )
+            if not rows:
+                logger.error("Does that user have made any post ?")
         except Exception as e:
             logger.error("Does that user have made any post ? Complete error : %s", e)
 
@@ -135,9 +132,7 @@ def main(args):
 
 
 def fetch_posts(api, username):
-    res = api.search_submissions(author=username)
-    df = pd.DataFrame([thing.d_ for thing in res])
-    return df
+    return api.search_submissions(author=username, filter=fields_of(COLUMNS))
 
 
 def parse_args():
@@ -162,7 +157,7 @@ def parse_args():
     parser.add_argument(
         "--export_format",
         type=str,
-        help="Export format (csv or xlsx). Default : csv",
+        help="Export format (csv, xlsx, parquet or sqlite). Default : csv",
         default="csv",
     )
     args = parser.parse_args()
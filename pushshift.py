@@ -0,0 +1,423 @@
+"""
+Pushshift endpoints shared by the scripts, and a concurrent crawler of
+their searches.
+
+The PUSHSHIFT_URL environment variable replaces https://api.pushshift.io,
+to query a mirror or the local server of the benchmarks.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from tqdm import tqdm
+
+import metrics
+import transport
+from storage import iter_chunks
+
+logger = logging.getLogger()
+
+PUSHSHIFT_URL = os.environ.get("PUSHSHIFT_URL", "https://api.pushshift.io").rstrip("/")
+SUBMISSION_SEARCH_URL = f"{PUSHSHIFT_URL}/reddit/search/submission"
+COMMENT_SEARCH_URL = f"{PUSHSHIFT_URL}/reddit/search/comment"
+# maximum number of results returned by a Pushshift request
+PAGE_SIZE = 1000
+# columns of the psaw exports computed from the other fields
+COMPUTED_FIELDS = ["date", "date_utc", "created"]
+# results per exported chunk
+CHUNK_SIZE = 10000
+# seconds of the buckets of the created_utc aggregations, coarsest first
+AGG_FREQUENCIES = {"day": 86400, "hour": 3600, "minute": 60, "second": 1}
+
+
+def psaw_api(limiter=None, **kwargs):
+    """
+    Return a psaw PushshiftAPI querying PUSHSHIFT_URL.
+
+    With limiter (a transport.RateLimiter), its requests also wait for the
+    request budget shared with other instances : an instance can only run
+    one search at a time, concurrent searches need one instance each.
+    """
+    from psaw import PushshiftAPI
+
+    class API(PushshiftAPI):
+        # formatted twice by psaw : first with the domain, then the endpoint
+        _base_url = PUSHSHIFT_URL.replace("{", "{{") + "/{{endpoint}}"
+
+        def _impose_rate_limit(self, nth_request=0):
+            if limiter is not None:
+                limiter.wait()
+            super()._impose_rate_limit(nth_request)
+
+    return API(**kwargs)
+
+
+def server_rate_limit():
+    """
+    Number of requests per minute allowed by the Pushshift server
+    """
+    return transport.get_json(f"{PUSHSHIFT_URL}/meta")["server_ratelimit_per_minute"]
+
+
+def fields_of(columns):
+    """
+    Pushshift fields to request for the columns of a psaw export
+    """
+    return [x for x in columns if x not in COMPUTED_FIELDS]
+
+
+def iter_frames(things, columns, chunk_size=CHUNK_SIZE):
+    """
+    Yield the psaw results things by dataframes of at most chunk_size rows,
+    with the columns of an export
+    """
+    # only the dicts of the results are kept, not the psaw namedtuples
+    for rows in iter_chunks((thing.d_ for thing in things), chunk_size):
+        yield result_frame(rows, columns)
+
+
+def result_frame(rows, columns):
+    """
+    Dataframe of a list of Pushshift results with the columns of a psaw
+    export, in their order. created (the local time of creation, added by
+    psaw) is needed for date.
+    """
+    fields = list(dict.fromkeys(fields_of(columns) + ["created_utc", "created"]))
+    df = pd.DataFrame(rows, columns=fields)
+    df["date_utc"] = pd.to_datetime(df["created_utc"], unit="s")
+    df["date"] = pd.to_datetime(df["created"], unit="s")
+    df["permalink"] = "https://old.reddit.com" + df["permalink"].astype(str)
+    return df[[x for x in columns if x in df.columns]]
+
+
+def search_terms(search, terms, subreddits, workers=1, limiter=None, rate_limit=None):
+    """
+    Search each term in each subreddit (everywhere without subreddits), the
+    queries running concurrently with one psaw instance each.
+    search(api, term, subreddit) returns the psaw results of one query.
+
+    The results are deduplicated by ID, kept as an integer, with the bitmask
+    of the terms they matched. Returns (results, matched) : the result dicts
+    by ID, and the bitmask of each ID.
+    """
+    results = {}
+    matched = {}
+    lock = threading.Lock()
+
+    def run(index, subreddit):
+        api = psaw_api(limiter=limiter, rate_limit_per_minute=rate_limit or None)
+        for thing in search(api, terms[index], subreddit):
+            key = int(thing.id, 36)
+            with lock:
+                if key not in results:
+                    results[key] = thing.d_
+                matched[key] = matched.get(key, 0) | 1 << index
+
+    queries = [(i, x) for i in range(len(terms)) for x in subreddits or [None]]
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run, *query): query for query in queries}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="queries"):
+            index, subreddit = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                logger.error(
+                    "Search of %s in %s failed. Complete error : %s",
+                    terms[index],
+                    subreddit,
+                    e,
+                )
+    if failed:
+        logger.error("%s/%s queries failed, results missing", failed, len(queries))
+    logger.info("%s results found by %s queries", len(results), len(queries) - failed)
+    return results, matched
+
+
+def iter_term_frames(results, matched, terms, columns, chunk_size=CHUNK_SIZE):
+    """
+    Yield the results of search_terms, newest first, by dataframes of at
+    most chunk_size rows with the columns of an export and the terms each
+    result matched (separated by commas)
+    """
+    keys = sorted(results, reverse=True)
+    for chunk in iter_chunks(keys, chunk_size):
+        df = result_frame([results[key] for key in chunk], columns)
+        df["terms"] = [
+            ",".join(x for i, x in enumerate(terms) if matched[key] >> i & 1)
+            for key in chunk
+        ]
+        yield df
+
+
+def search(url, params, delay=0, limiter=None):
+    """
+    Return the response of a single Pushshift search request, sent after
+    sleeping delay seconds and waiting for limiter (a transport.RateLimiter)
+    """
+    metrics.count("ratelimit_sleep_seconds", delay)
+    time.sleep(delay)
+    if limiter is not None:
+        limiter.wait()
+    # allow 5 fails before exiting
+    data = transport.get_json(
+        url, params=dict({"size": PAGE_SIZE}, **params), retries=5
+    )
+    metrics.count("pushshift_pages")
+    return data
+
+
+def time_span(url, params, delay=0, limiter=None):
+    """
+    Return the creation dates of the oldest and newest results of a search,
+    or None if it has no result
+    """
+    probe = dict(params, size=1, sort_type="created_utc", filter="created_utc")
+    oldest = search(url, dict(probe, sort="asc"), delay=delay, limiter=limiter)["data"]
+    if not oldest:
+        return None
+    newest = search(url, dict(probe, sort="desc"), delay=delay, limiter=limiter)["data"]
+    return int(oldest[0]["created_utc"]), int(newest[0]["created_utc"])
+
+
+def histogram(url, params, after, before, frequency, delay=0, limiter=None):
+    """
+    Return the (start, count) buckets of the results of a search created
+    between after and before, aggregated by frequency, or None if the
+    server does not aggregate them
+    """
+    response = search(
+        url,
+        dict(
+            params,
+            after=after,
+            before=before,
+            size=0,
+            aggs="created_utc",
+            frequency=frequency,
+        ),
+        delay=delay,
+        limiter=limiter,
+    )
+    metrics.count("pushshift_probes")
+    buckets = response.get("aggs", {}).get("created_utc")
+    if buckets is None:
+        return None
+    return [(int(x["key"]), x["doc_count"]) for x in buckets if x["doc_count"]]
+
+
+def plan_windows(
+    url, params, after, before, workers=1, unit=PAGE_SIZE, delay=0, limiter=None
+):
+    """
+    Split the time window of a search in work units of at most unit results.
+
+    The results are counted by day with one aggregation request, and the
+    days holding more than unit results are aggregated again by hour, then
+    by minute and second. Consecutive buckets are then merged while their
+    counts add up to at most unit.
+    Returns the list of (after, before, count) units, or None if the server
+    does not aggregate the results.
+    """
+    frequencies = list(AGG_FREQUENCIES)
+
+    def aggregate(lo, hi, level):
+        buckets = histogram(
+            url, params, lo, hi, frequencies[level], delay=delay, limiter=limiter
+        )
+        if buckets is None:
+            return None
+        width = AGG_FREQUENCIES[frequencies[level]]
+        # a bucket holds the results created in [start, start + width[
+        return [
+            (max(start - 1, lo), min(start + width, hi), count, level + 1)
+            for start, count in buckets
+        ]
+
+    pending = aggregate(after, before, 0)
+    if pending is None:
+        return None
+    windows = []
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for lo, hi, count, level in pending:
+                if count <= unit or level == len(frequencies):
+                    windows.append((lo, hi, count))
+                else:
+                    future = executor.submit(aggregate, lo, hi, level)
+                    futures[future] = (lo, hi, count)
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            pending = []
+            for future in done:
+                window = futures.pop(future)
+                buckets = future.result()
+                if buckets is None:
+                    # left to the splitting of the full pages
+                    windows.append(window)
+                else:
+                    pending.extend(buckets)
+    units = merge_windows(sorted(windows), unit)
+    logger.debug(
+        "%s results planned in %s units from %s buckets",
+        sum(x[2] for x in units),
+        len(units),
+        len(windows),
+    )
+    return units
+
+
+def merge_windows(windows, unit):
+    """
+    Merge the consecutive (after, before, count) windows while their counts
+    add up to at most unit
+    """
+    units = []
+    for lo, hi, count in windows:
+        if units and units[-1][2] + count <= unit:
+            units[-1] = (units[-1][0], hi, units[-1][2] + count)
+        else:
+            units.append((lo, hi, count))
+    return units
+
+
+def crawl(
+    url,
+    params,
+    after,
+    before,
+    shards=1,
+    workers=1,
+    journal=None,
+    delay=0,
+    limiter=None,
+    fields=None,
+    plan=True,
+):
+    """
+    Get the results of a Pushshift search created between after and before.
+
+    With plan, the time window is first split in units of about one page
+    of results by plan_windows, otherwise (or if the server does not
+    aggregate the results) in shards. The windows are fetched concurrently.
+    A window whose page is full is split again, in as many parts as its
+    number of results needs pages (or in halves if the server does not
+    count them), until each part fits in one page.
+    The plan and every fetched page are written to the journal, pages
+    already in it are not requested again. With fields, only these fields
+    of the results are requested (id and created_utc are always kept).
+    Each request sleeps delay seconds and waits for limiter (a
+    transport.RateLimiter shared by the workers).
+    Returns the results deduplicated by ID, sorted by creation date.
+    """
+    if fields is not None:
+        fields = list(dict.fromkeys(["id", "created_utc", *fields]))
+        params = dict(params, filter=",".join(fields))
+    pages = {}
+    windows = None
+    if journal is not None:
+        pages = {
+            (x["after"], x["before"]): x
+            for x in journal.records_of("page")
+            if "results" in x
+        }
+        logger.debug("%s Pushshift pages already in the journal", len(pages))
+        # the counts may have changed since : keep the windows of the pages
+        plans = journal.records_of("plan")
+        if plans:
+            windows = [(lo, hi) for lo, hi, _ in plans[-1]["units"]]
+    # a journal without plan was split in shards
+    if windows is None and plan and not pages:
+        units = plan_windows(
+            url,
+            params,
+            after,
+            before,
+            workers=workers,
+            delay=delay,
+            limiter=limiter,
+        )
+        if units is not None:
+            windows = [(lo, hi) for lo, hi, _ in units]
+            if journal is not None:
+                journal.write({"type": "plan", "units": units})
+    if windows is None:
+        windows = split_window(after, before, shards)
+
+    def fetch_window(lo, hi):
+        if (lo, hi) in pages:
+            return pages[(lo, hi)]
+        response = search(
+            url,
+            dict(params, after=lo, before=hi, metadata="true"),
+            delay=delay,
+            limiter=limiter,
+        )
+        data = response["data"]
+        # the page size of the server may be lower than PAGE_SIZE : the page
+        # is full when the window holds more results than the page
+        total = response.get("metadata", {}).get("total_results")
+        page = {
+            "type": "page",
+            "after": lo,
+            "before": hi,
+            "results": data,
+            "full": len(data) < total if total else len(data) >= PAGE_SIZE,
+            "total": total,
+        }
+        if journal is not None:
+            journal.write(page)
+        return page
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch_window, lo, hi): (lo, hi) for lo, hi in windows
+        }
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                lo, hi = futures.pop(future)
+                page = future.result()
+                for result in page["results"]:
+                    results[result["id"]] = result
+                if not page["full"]:
+                    continue
+                if hi - lo <= 2:
+                    logger.warning(
+                        "Window %s-%s is full but can't be split further", lo, hi
+                    )
+                    continue
+                parts = 2
+                if page.get("total") and page["results"]:
+                    parts = math.ceil(page["total"] / len(page["results"]))
+                logger.debug("Splitting window %s-%s in %s", lo, hi, parts)
+                for sub_lo, sub_hi in split_window(lo, hi, parts):
+                    future = executor.submit(fetch_window, sub_lo, sub_hi)
+                    futures[future] = (sub_lo, sub_hi)
+            logger.debug(
+                "%s results found, %s windows left", len(results), len(futures)
+            )
+
+    return sorted(results.values(), key=lambda x: (x["created_utc"], x["id"]))
+
+
+def split_window(after, before, parts):
+    """
+    Split the time window (after, before) in at most parts windows
+    """
+    # Pushshift's after and before are exclusive : a window (lo, hi) holds
+    # the results created in ]lo, hi[, so consecutive windows overlap by one
+    # second and (lo, mid + 1), (mid, hi) cover (lo, hi)
+    step = max(math.ceil((before - after) / max(parts, 1)), 1)
+    bounds = list(range(after, before, step)) + [before]
+    windows = [(lo, min(hi + 1, before)) for lo, hi in zip(bounds, bounds[1:])]
+    # a window of one second holds nothing
+    return [(lo, hi) for lo, hi in windows if hi - lo > 1]
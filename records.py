@@ -0,0 +1,185 @@
+"""
+Column builders of the exported posts and comments.
+
+The fields of each record (a praw submission or comment) are appended to
+one list per column instead of being stored in a dict per row : the lists
+become the columns of the dataframe, without any per-row dict, which
+would cost hundreds of bytes for each of millions of comments.
+
+    comments = Columns(COMMENT_FIELDS).extend(comment_list)
+    df = comments.frame(["ID", "Date", "Comment"])
+"""
+
+from operator import attrgetter
+
+import pandas as pd
+
+import metrics
+
+# fields of the posts, by column
+POST_FIELDS = {
+    "ID": attrgetter("name"),
+    "Title": attrgetter("title"),
+    "Date": attrgetter("created_utc"),
+    "Score": attrgetter("score"),
+    "Ratio": attrgetter("upvote_ratio"),
+    "Comments": attrgetter("num_comments"),
+    "Flair": lambda x: str(x.link_flair_text),
+    "Domain": attrgetter("domain"),
+    "Text": lambda x: str(x.selftext),
+    "URL": attrgetter("url"),
+    "Permalink": lambda x: f"https://reddit.com{x.permalink}",
+    "Author": lambda x: str(x.author),
+    "Author CSS Flair": lambda x: str(x.author_flair_css_class),
+    "Author Text Flair": lambda x: str(x.author_flair_text),
+    "Gilded": attrgetter("gilded"),
+    "Can Gild": attrgetter("can_gild"),
+    "Hidden": attrgetter("hidden"),
+    "Archived": attrgetter("archived"),
+    "Can Crosspost": attrgetter("is_crosspostable"),
+    "Subreddit": attrgetter("subreddit.display_name"),
+}
+# fields of the comments, by column
+COMMENT_FIELDS = {
+    "ID": attrgetter("id"),
+    "Subreddit": attrgetter("subreddit.display_name"),
+    "Date": attrgetter("created_utc"),
+    "Author": lambda x: x.author.name if x.author else "[deleted]",
+    "Comment": attrgetter("body"),
+    "Score": attrgetter("score"),
+    "Length": lambda x: len(x.body),
+    "Gilded": attrgetter("gilded"),
+    "Parent": attrgetter("parent_id"),
+    "Flair": attrgetter("author_flair_text"),
+    "Permalink": lambda x: f"https://reddit.com{x.permalink}",
+    # only the comments of listings (user, stream...) hold their post
+    "Post ID": lambda x: x.link_id[3:],
+    "Post Permalink": attrgetter("link_permalink"),
+    "Post Title": attrgetter("link_title"),
+    "Post Author": attrgetter("link_author"),
+    "Post URL": attrgetter("link_url"),
+}
+# columns of the comments export
+COLUMNS = [
+    "ID",
+    "Subreddit",
+    "Date",
+    "Author",
+    "Comment",
+    "Score",
+    "Length",
+    "Gilded",
+    "Parent",
+    "Flair",
+    "Post ID",
+    "Post Permalink",
+    "Post Title",
+    "Post Author",
+    "Post URL",
+    "Permalink",
+]
+# columns of the comments export, with --normalize
+NORMALIZED_COLUMNS = [
+    "ID",
+    "Subreddit",
+    "Date",
+    "Author",
+    "Comment",
+    "Score",
+    "Length",
+    "Gilded",
+    "Parent",
+    "Flair",
+    "Post ID",
+    "Permalink",
+]
+
+
+class Columns:
+    """
+    Columns of an export, filled one record at a time.
+
+    fields maps each column to the function extracting its value from a
+    record. columns holds the list of the values of each column.
+    """
+
+    __slots__ = ("fields", "columns", "_appends")
+
+    def __init__(self, fields, columns=None):
+        self.fields = fields
+        self.columns = columns or {name: [] for name in fields}
+        self._appends = [(self.columns[name].append, fields[name]) for name in fields]
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), []))
+
+    def append(self, thing):
+        for append, field in self._appends:
+            append(field(thing))
+
+    def extend(self, things):
+        for thing in things:
+            self.append(thing)
+        return self
+
+    def update(self, columns):
+        """
+        Append the values of columns (a dict of lists, as Columns.columns)
+        """
+        for name, values in columns.items():
+            self.columns[name].extend(values)
+
+    def split(self, size):
+        """
+        Return the Columns of the first size records and of the others
+        """
+        head = {name: values[:size] for name, values in self.columns.items()}
+        tail = {name: values[size:] for name, values in self.columns.items()}
+        return Columns(self.fields, head), Columns(self.fields, tail)
+
+    def frame(self, columns=None, constants=None):
+        """
+        Return the dataframe of the records, with the given columns in this
+        order. constants gives the value of the columns shared by all the
+        records.
+        """
+        data = dict(self.columns)
+        for name, value in (constants or {}).items():
+            data[name] = [value] * len(self)
+        return pd.DataFrame(data, columns=columns)
+
+
+def comments_frame(comments, normalize=False, post=None):
+    """
+    Build the export dataframe of the Columns of comments, post giving the
+    columns shared by all of them
+    """
+    with metrics.phase("dataframe"):
+        df = comments.frame(
+            NORMALIZED_COLUMNS if normalize else COLUMNS, constants=post
+        )
+        df["Date"] = pd.to_datetime(df["Date"], unit="s")
+    return df
+
+
+def select_fields(fields, columns):
+    """
+    Return the fields of the given columns, in their order (the columns
+    missing from fields are left out)
+    """
+    return {name: fields[name] for name in columns if name in fields}
+
+
+def iter_column_chunks(batches, fields, size):
+    """
+    Regroup the Columns of batches in Columns of size records (the last one
+    holding the remaining records)
+    """
+    chunk = Columns(fields)
+    for batch in batches:
+        chunk.update(batch.columns)
+        while len(chunk) >= size:
+            head, chunk = chunk.split(size)
+            yield head
+    if len(chunk):
+        yield chunk
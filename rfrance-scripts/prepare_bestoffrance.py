@@ -18,7 +18,10 @@ def index_containing_substring(the_list, substring):
 
 def main():
     # df = pd.read_excel(sys.argv[1])
-    df = pd.read_csv(sys.argv[1], sep="\t", encoding="utf-8")
+    if sys.argv[1].endswith(".parquet"):
+        df = pd.read_parquet(sys.argv[1])
+    else:
+        df = pd.read_csv(sys.argv[1], sep="\t", encoding="utf-8")
 
     Texte = df["Text"].str.split("\n")
 
@@ -13,7 +13,10 @@ STARTTIME = time.time()
 
 def main():
     # df = pd.read_excel(sys.argv[1])
-    df = pd.read_csv(sys.argv[1], sep="\t", encoding="utf-8")
+    if sys.argv[1].endswith(".parquet"):
+        df = pd.read_parquet(sys.argv[1])
+    else:
+        df = pd.read_csv(sys.argv[1], sep="\t", encoding="utf-8")
     df_fl = df[df["Flair"] == "Forum Libre"]
     df_fl = df_fl[df_fl["Title"].str.contains("Forum Libre")]
     df_fl = df_fl[df_fl["Author"] == "AutoModerator"]
@@ -0,0 +1,583 @@
+"""
+Readers and writers shared by the scripts to import and export their results.
+"""
+
+import io
+import json
+import logging
+import os
+import sqlite3
+import pandas as pd
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+logger = logging.getLogger()
+
+# formats which can be written chunk by chunk, with their extension
+STREAM_FORMATS = {
+    "csv": "csv",
+    "jsonl": "jsonl",
+    "parquet": "parquet",
+    "sqlite": "sqlite",
+}
+# types of the known columns, used by the typed formats (parquet)
+CATEGORY_COLUMNS = [
+    "Author",
+    "Flair",
+    "Domain",
+    "Subreddit",
+    "author",
+    "domain",
+    "link_flair_text",
+    "subreddit",
+]
+INT_COLUMNS = ["Score", "Comments", "Gilded", "Length", "num_comments", "score"]
+BOOL_COLUMNS = ["Hidden", "Archived", "Can Gild", "Can Crosspost"]
+DATE_COLUMNS = ["Date", "date", "date_utc"]
+# column sorted on to give each parquet row group a narrow date range
+SORT_COLUMN = "Date"
+# column of the exports whose rows are in the preorder of comment trees,
+# which must not be sorted
+TREE_COLUMN = "Position"
+PARQUET_ROW_GROUP_SIZE = 100000
+# formats which can be indexed for incremental runs
+INDEXED_FORMATS = ["csv", "jsonl"]
+INDEX_ID_COLUMN = "ID"
+INDEX_DATE_COLUMN = "Date"
+# database shared by all the exports in the sqlite format, one table per kind
+# of record (posts, comments...)
+SQLITE_DATABASE = os.environ.get("REDDIT_SQLITE", "reddit.sqlite")
+# unique key of the rows of a table, the first one found in its columns
+SQLITE_KEY_COLUMNS = ["ID", "id", "Post ID"]
+SQLITE_INDEX_COLUMNS = ["Date", "Author", "Post ID", "date", "author", "link_id"]
+# rows per insert transaction
+SQLITE_BATCH_SIZE = 10000
+# seconds a writer waits for the lock of another one
+SQLITE_TIMEOUT = 60
+# rows per indexed chunk
+INDEX_CHUNK_SIZE = 10000
+
+
+class TextWriter(ABC):
+    """
+    Text file written chunk by chunk.
+
+    An indexed writer also keeps, in a JSON sidecar file, the byte range,
+    the IDs and the date range of each chunk. A later incremental run can
+    then copy the unchanged chunks byte for byte (see merge_export) instead
+    of parsing the whole file.
+    """
+
+    def __init__(self, path, indexed=False):
+        self.path = path
+        self.indexed = indexed
+        self.rows = 0
+        self.columns = None
+        self.chunks = []
+
+    def write_header(self, columns):
+        open(self.path, "w").close()
+
+    @abstractmethod
+    def append(self, df):
+        """
+        Append the rows of df to the file
+        """
+
+    @abstractmethod
+    def parse(self, data):
+        """
+        Read back the rows of a chunk written by append
+        """
+
+    def write(self, df):
+        if self.columns is None:
+            self.columns = list(df.columns)
+            self.write_header(self.columns)
+        elif list(df.columns) != self.columns:
+            raise ValueError(f"Columns written to {self.path} differ from its header")
+        size = INDEX_CHUNK_SIZE if self.indexed else max(len(df), 1)
+        for start in range(0, len(df), size):
+            chunk = df.iloc[start : start + size]
+            offset = os.path.getsize(self.path)
+            self.append(chunk)
+            if self.indexed:
+                dates = pd.to_datetime(chunk[INDEX_DATE_COLUMN])
+                self.chunks.append(
+                    {
+                        "offset": offset,
+                        "end": os.path.getsize(self.path),
+                        "rows": len(chunk),
+                        "date_min": dates.min().timestamp(),
+                        "date_max": dates.max().timestamp(),
+                        "ids": chunk[INDEX_ID_COLUMN].tolist(),
+                    }
+                )
+            self.rows += len(chunk)
+
+    def copy_chunk(self, data, chunk):
+        """
+        Append a chunk of an indexed file written with the same columns
+        """
+        offset = os.path.getsize(self.path)
+        with open(self.path, "ab") as f:
+            f.write(data)
+        self.chunks.append(dict(chunk, offset=offset, end=offset + len(data)))
+        self.rows += chunk["rows"]
+
+    def close(self):
+        if self.columns is None:
+            logger.debug("Nothing written to %s", self.path)
+            return
+        if self.indexed:
+            with open(index_path(self.path), "w") as f:
+                json.dump(
+                    {
+                        "columns": self.columns,
+                        "rows": self.rows,
+                        "date_max": max(
+                            (x["date_max"] for x in self.chunks), default=None
+                        ),
+                        "chunks": self.chunks,
+                    },
+                    f,
+                )
+        logger.debug("%s rows written to %s", self.rows, self.path)
+
+
+class CsvWriter(TextWriter):
+    """
+    Tab separated file
+    """
+
+    def write_header(self, columns):
+        pd.DataFrame(columns=columns).to_csv(self.path, index=False, sep="\t")
+
+    def append(self, df):
+        df.to_csv(self.path, mode="a", header=False, index=False, sep="\t")
+
+    def parse(self, data):
+        return pd.read_csv(
+            io.BytesIO(data),
+            sep="\t",
+            header=None,
+            names=self.columns,
+            encoding="utf-8",
+        )
+
+
+class JsonLinesWriter(TextWriter):
+    """
+    JSON file with one record per line
+    """
+
+    def append(self, df):
+        text = df.to_json(orient="records", lines=True, date_format="iso")
+        with open(self.path, "a", encoding="utf-8") as f:
+            # older pandas versions don't end the last line
+            f.write(text if text.endswith("\n") else text + "\n")
+
+    def parse(self, data):
+        return pd.read_json(io.BytesIO(data), lines=True)
+
+
+class ParquetWriter:
+    """
+    Parquet file with the typed schema of the first chunk, one row group
+    (with min/max statistics on the dates) per chunk
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self._schema = None
+        self._writer = None
+
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        df = apply_schema(df)
+        if self._writer is None:
+            self._schema = arrow_schema(df)
+            self._writer = pq.ParquetWriter(
+                self.path,
+                self._schema,
+                write_statistics=[c for c in DATE_COLUMNS if c in df.columns],
+            )
+        table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        self._writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        logger.debug("%s rows written to %s", self.rows, self.path)
+
+
+class SqliteWriter:
+    """
+    Table of the shared SQLite database, in WAL mode, where the rows are
+    upserted on their ID : rows already in the table are updated, so that
+    every run accumulates in the same table.
+
+    The table is created with the columns of the first chunk, columns
+    missing from an existing table are added.
+    """
+
+    def __init__(self, path, table):
+        self.path = path
+        self.table = table
+        self.rows = 0
+        self.columns = None
+        self.key = None
+        self._connection = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+
+    def create_table(self, df):
+        self.key = next((c for c in SQLITE_KEY_COLUMNS if c in df.columns), None)
+        if self.key is None:
+            raise ValueError(f"No ID column to upsert the rows of {self.table} on")
+        self.columns = list(df.columns)
+        definitions = ", ".join(
+            f"{quote(c)} {sqlite_type(df[c])}"
+            + (" PRIMARY KEY" if c == self.key else "")
+            for c in self.columns
+        )
+        with self._connection:
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {quote(self.table)} ({definitions})"
+            )
+            existing = {
+                row[1]
+                for row in self._connection.execute(
+                    f"PRAGMA table_info({quote(self.table)})"
+                )
+            }
+            for column in self.columns:
+                if column not in existing:
+                    self._connection.execute(
+                        f"ALTER TABLE {quote(self.table)} ADD COLUMN "
+                        f"{quote(column)} {sqlite_type(df[column])}"
+                    )
+            for column in SQLITE_INDEX_COLUMNS:
+                if column in self.columns and column != self.key:
+                    name = f"{self.table}_{column}".replace(" ", "_").lower()
+                    self._connection.execute(
+                        f"CREATE INDEX IF NOT EXISTS {quote(name)} "
+                        f"ON {quote(self.table)} ({quote(column)})"
+                    )
+
+    def write(self, df):
+        if self.columns is None:
+            self.create_table(df)
+        elif list(df.columns) != self.columns:
+            raise ValueError(
+                f"Columns written to {self.table} differ from the first ones"
+            )
+        columns = ", ".join(quote(c) for c in self.columns)
+        updates = ", ".join(
+            f"{quote(c)} = excluded.{quote(c)}" for c in self.columns if c != self.key
+        )
+        query = (
+            f"INSERT INTO {quote(self.table)} ({columns}) "
+            f"VALUES ({', '.join('?' * len(self.columns))}) "
+            f"ON CONFLICT({quote(self.key)}) DO "
+            + (f"UPDATE SET {updates}" if updates else "NOTHING")
+        )
+        for start in range(0, len(df), SQLITE_BATCH_SIZE):
+            rows = sqlite_rows(df.iloc[start : start + SQLITE_BATCH_SIZE])
+            # one transaction per batch
+            with self._connection:
+                self._connection.executemany(query, rows)
+        self.rows += len(df)
+
+    def close(self):
+        self._connection.close()
+        logger.debug("%s rows written to %s in %s", self.rows, self.table, self.path)
+
+
+def quote(name):
+    """
+    Quote an SQL identifier
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sqlite_type(series):
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(series):
+        return "REAL"
+    return "TEXT"
+
+
+def sqlite_rows(df):
+    """
+    Rows of df as tuples of Python values, the dates as ISO 8601 text and
+    the missing values as NULL
+    """
+    columns = []
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            series = series.dt.strftime("%Y-%m-%d %H:%M:%S")
+        series = series.astype(object)
+        columns.append(series.where(series.notna(), None).tolist())
+    return list(zip(*columns))
+
+
+def apply_schema(df):
+    """
+    Return df with the known columns converted to their type
+    """
+    df = df.copy()
+    for column in df.columns:
+        if column in CATEGORY_COLUMNS:
+            df[column] = df[column].astype("category")
+        elif column in INT_COLUMNS:
+            df[column] = pd.to_numeric(df[column]).astype("Int32")
+        elif column in BOOL_COLUMNS:
+            df[column] = df[column].astype("boolean")
+        elif column in DATE_COLUMNS:
+            df[column] = pd.to_datetime(df[column])
+    return df
+
+
+def categorize(df):
+    """
+    Return df with its low cardinality columns (CATEGORY_COLUMNS) dictionary
+    encoded
+    """
+    df = df.copy()
+    for column in df.columns:
+        if column in CATEGORY_COLUMNS:
+            df[column] = df[column].astype("category")
+    return df
+
+
+def arrow_schema(df):
+    """
+    Arrow schema of df, with the same dictionary type for all the
+    categorical columns so that every chunk can be cast to it
+    """
+    import pyarrow as pa
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    return pa.schema(
+        [
+            (
+                pa.field(field.name, pa.dictionary(pa.int32(), pa.string()))
+                if pa.types.is_dictionary(field.type)
+                else field
+            )
+            for field in schema
+        ],
+        metadata=schema.metadata,
+    )
+
+
+def write_dataframe(df, filename, export_format, indexed=False, table=None):
+    """
+    Export a whole dataframe to filename (without extension).
+
+    In the sqlite format, df is upserted in the table of the shared database
+    (by default named after the start of the file name : posts, comments...)
+    """
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    if export_format == "xlsx":
+        with pd.ExcelWriter(
+            f"{filename}.xlsx",
+            engine="xlsxwriter",
+            engine_kwargs={"options": {"strings_to_urls": False}},
+        ) as writer:
+            df.to_excel(writer, sheet_name="Sheet1", index=False)
+    elif export_format == "parquet":
+        if SORT_COLUMN in df.columns and TREE_COLUMN not in df.columns:
+            df = df.sort_values(SORT_COLUMN, kind="stable")
+        writer = ParquetWriter(f"{filename}.parquet")
+        # an empty dataframe still gives a file with the schema
+        for start in range(0, max(len(df), 1), PARQUET_ROW_GROUP_SIZE):
+            writer.write(df.iloc[start : start + PARQUET_ROW_GROUP_SIZE])
+        writer.close()
+    else:
+        writer = open_writer(filename, export_format, indexed=indexed, table=table)
+        writer.write(df)
+        writer.close()
+
+
+def write_frames(frames, filename, export_format, table=None):
+    """
+    Export dataframes with the same columns to filename (without extension),
+    one after the other in the stream formats. Returns the number of rows
+    written, nothing is written without rows.
+    """
+    if export_format in STREAM_FORMATS:
+        writer = open_writer(filename, export_format, table=table)
+        rows = 0
+        for df in frames:
+            writer.write(df)
+            rows += len(df)
+        writer.close()
+        return rows
+    frames = list(frames)
+    if not frames:
+        return 0
+    df = pd.concat(frames, ignore_index=True)
+    write_dataframe(df, filename, export_format, table=table)
+    return len(df)
+
+
+def read_dataframe(path, import_format):
+    """
+    Import a file exported by one of the scripts
+    """
+    if import_format == "xlsx":
+        return pd.read_excel(path)
+    if import_format == "parquet":
+        return pd.read_parquet(path)
+    return pd.read_csv(path, sep="\t", encoding="utf-8")
+
+
+def open_writer(filename, export_format, indexed=False, table=None):
+    """
+    Return a writer for filename (without extension) in a streamable format.
+
+    indexed is ignored by the formats which can't be indexed. In the sqlite
+    format, the rows go to the table of the shared database (see
+    write_dataframe).
+    """
+    if export_format not in STREAM_FORMATS:
+        raise ValueError(
+            f"Export format {export_format} can't be streamed, use one of "
+            + ", ".join(STREAM_FORMATS)
+        )
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    path = f"{filename}.{STREAM_FORMATS[export_format]}"
+    if export_format == "sqlite":
+        return SqliteWriter(SQLITE_DATABASE, table or table_name(filename))
+    if export_format == "jsonl":
+        return JsonLinesWriter(path, indexed=indexed)
+    if export_format == "parquet":
+        return ParquetWriter(path)
+    return CsvWriter(path, indexed=indexed)
+
+
+def table_name(filename):
+    """
+    Table of the records of an export : the start of its file name
+    (comments_1577836800_user gives comments)
+    """
+    return Path(filename).name.split("_")[0]
+
+
+def index_path(path):
+    """
+    Path of the sidecar index of an export
+    """
+    return f"{path}.index.json"
+
+
+def read_index(path, import_format):
+    """
+    Return the sidecar index of an export, None if it has none
+    """
+    if import_format not in INDEXED_FORMATS or not Path(index_path(path)).exists():
+        return None
+    with open(index_path(path), "r") as f:
+        return json.load(f)
+
+
+def state_path(path):
+    """
+    Path of the sidecar state of an export, used by the incremental runs
+    """
+    return f"{path}.state.json"
+
+
+def read_state(path):
+    """
+    Return the sidecar state of an export, None if it has none
+    """
+    if not Path(state_path(path)).exists():
+        return None
+    with open(state_path(path), "r") as f:
+        return json.load(f)
+
+
+def write_state(path, state):
+    with open(state_path(path), "w") as f:
+        json.dump(state, f)
+
+
+def merge_export(writer, path, index, drop_ids, date_max=None):
+    """
+    Copy the rows of a previous indexed export to writer, except the ones
+    whose ID is in drop_ids or whose date is after date_max (unixstamp).
+
+    Only the chunks holding such rows are parsed, the other ones are copied
+    byte for byte. If writer already holds rows (the new ones, which the
+    exports write before the previous ones), they must have the columns of
+    the previous export.
+    """
+    if writer.columns is None:
+        writer.columns = index["columns"]
+        writer.write_header(writer.columns)
+    elif writer.columns != index["columns"]:
+        raise ValueError(
+            f"Columns of {path} differ from the ones written to {writer.path}"
+        )
+    parsed = 0
+    with open(path, "rb") as f:
+        for chunk in index["chunks"]:
+            f.seek(chunk["offset"])
+            data = f.read(chunk["end"] - chunk["offset"])
+            if (
+                date_max is None or chunk["date_max"] <= date_max
+            ) and drop_ids.isdisjoint(chunk["ids"]):
+                writer.copy_chunk(data, chunk)
+                continue
+            parsed += 1
+            df = writer.parse(data)
+            keep = ~df[INDEX_ID_COLUMN].isin(drop_ids)
+            if date_max is not None:
+                dates = pd.to_datetime(df[INDEX_DATE_COLUMN])
+                keep &= dates <= pd.to_datetime(date_max, unit="s")
+            if keep.any():
+                writer.write(df[keep])
+    logger.debug("%s/%s chunks of %s parsed", parsed, len(index["chunks"]), path)
+
+
+def iter_chunks(iterable, chunk_size):
+    """
+    Group the items of an iterable in lists of at most chunk_size items
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_frame_chunks(frames, chunk_size):
+    """
+    Concatenate an iterable of dataframes in dataframes of at least
+    chunk_size rows (except the last one)
+    """
+    chunk = []
+    rows = 0
+    for df in frames:
+        if df.empty:
+            continue
+        chunk.append(df)
+        rows += len(df)
+        if rows >= chunk_size:
+            yield pd.concat(chunk, ignore_index=True)
+            chunk = []
+            rows = 0
+    if chunk:
+        yield pd.concat(chunk, ignore_index=True)
@@ -0,0 +1,188 @@
+"""
+Shared HTTP transport for the scripts calling web APIs directly.
+
+All the requests go through one keep-alive session, so each host only pays
+the TCP/TLS handshake once per pooled connection.
+"""
+
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+import metrics
+from cache import CACHED_REASON, CachingAdapter, ResponseCache
+
+logger = logging.getLogger()
+
+# number of connections kept open per host
+POOL_SIZE = 10
+# number of hosts whose pool is kept
+POOL_HOSTS = 4
+HEADERS = {
+    "User-Agent": "python:script:reddit-scraper",
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+}
+# status codes worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class RateLimiter:
+    """
+    Budget of requests per minute shared by all the threads : each request
+    gets the next free slot, evenly spaced, and sleeps until it
+    """
+
+    def __init__(self, per_minute, hosts=None):
+        self.interval = 60 / per_minute
+        self.hosts = set(hosts) if hosts is not None else None
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def applies(self, url):
+        return self.hosts is None or urlsplit(url).hostname in self.hosts
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            metrics.count("ratelimit_sleep_seconds", slot - now)
+            time.sleep(slot - now)
+
+
+class ThrottledAdapter(HTTPAdapter):
+    """
+    Transport adapter waiting for the RateLimiter before each request
+    """
+
+    def __init__(self, *args, limiter=None, **kwargs):
+        self.limiter = limiter
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if self.limiter is not None and self.limiter.applies(request.url):
+            self.limiter.wait()
+        return super().send(request, **kwargs)
+
+
+class ThrottledCachingAdapter(CachingAdapter, ThrottledAdapter):
+    """
+    Caching adapter whose cache misses wait for the RateLimiter
+    """
+
+
+def create_session(
+    pool_size=POOL_SIZE,
+    pool_hosts=POOL_HOSTS,
+    cache_dir=None,
+    rate_limit=None,
+    rate_limit_hosts=None,
+):
+    """
+    Create a keep-alive session asking for compressed responses.
+
+    At most pool_size connections are opened per host : when all of them
+    are busy, the next request waits for one to be released.
+    With a cache_dir, GET responses are cached on disk.
+    With a rate_limit, at most rate_limit requests per minute are sent to
+    rate_limit_hosts (all hosts by default), whatever the number of threads.
+    """
+    session = requests.Session()
+    pool = {
+        "pool_connections": pool_hosts,
+        "pool_maxsize": pool_size,
+        "pool_block": True,
+    }
+    if rate_limit:
+        pool["limiter"] = RateLimiter(rate_limit, hosts=rate_limit_hosts)
+    if cache_dir is not None:
+        adapter = ThrottledCachingAdapter(ResponseCache(cache_dir), **pool)
+    else:
+        adapter = ThrottledAdapter(**pool)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(HEADERS)
+    session.hooks["response"].append(count_response)
+    return session
+
+
+def count_response(response, *args, **kwargs):
+    """
+    Session hook counting the responses in the metrics of the run
+    """
+    metrics.count("http_requests")
+    if response.reason == CACHED_REASON:
+        metrics.count("http_cache_hits")
+    if response.status_code >= 400:
+        metrics.count(f"http_status_{response.status_code}")
+
+
+def configure(
+    pool_size=POOL_SIZE,
+    pool_hosts=POOL_HOSTS,
+    cache_dir=None,
+    rate_limit=None,
+    rate_limit_hosts=None,
+):
+    """
+    Replace the shared session by one with the given settings.
+
+    Call it before creating the clients using the shared session.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = create_session(
+            pool_size=pool_size,
+            pool_hosts=pool_hosts,
+            cache_dir=cache_dir,
+            rate_limit=rate_limit,
+            rate_limit_hosts=rate_limit_hosts,
+        )
+    return _session
+
+
+def get_session():
+    """
+    Return the shared session, creating it with the default settings
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+    return _session
+
+
+def get_json(url, params=None, retries=5, backoff=3):
+    """
+    GET an url with the shared session and return the decoded JSON.
+
+    429 and 5xx responses are retried up to retries times, waiting backoff
+    seconds more after each failure.
+    """
+    session = get_session()
+    for attempt in range(1, retries + 2):
+        req = session.get(url, params=params)
+        if req.status_code not in RETRY_STATUS or attempt > retries:
+            break
+        logger.debug(
+            "Status %s for %s, retrying (%s/%s)",
+            req.status_code,
+            req.url,
+            attempt,
+            retries,
+        )
+        metrics.count("http_retries")
+        metrics.count("retry_sleep_seconds", backoff * attempt)
+        time.sleep(backoff * attempt)
+    req.raise_for_status()
+    return req.json()